@@ -452,6 +452,25 @@ class Bitmap(object):
        doc = '''A typeless pointer to the bitmap buffer. This value should be
                 aligned on 32-bit boundaries in most cases.''')
 
+    def _get_array(self):
+        import numpy
+        rows, pitch = self.rows, abs(self.pitch)
+        if rows == 0 or pitch == 0 or not self._FT_Bitmap.buffer:
+            return numpy.zeros((rows, self.width), numpy.uint8)
+        data = cast(self._FT_Bitmap.buffer, POINTER(c_ubyte*(rows*pitch))).contents
+        array = numpy.frombuffer(data, numpy.uint8).reshape(rows, pitch)
+        if self.pitch < 0:
+            array = array[::-1]
+        if self.pixel_mode == FT_PIXEL_MODE_GRAY:
+            array = array[:,:self.width]
+        return array
+    array = property(_get_array,
+       doc = '''A numpy array (rows x pitch bytes, or rows x width pixels for
+                grays) viewing the bitmap buffer without copying it. Rows are
+                always ordered top to bottom. Note that the view shares memory
+                with FreeType, it is only valid until the next glyph is loaded
+                into the same slot.''')
+
     num_grays = property(lambda self: self._FT_Bitmap.num_grays,
           doc = '''This field is only used with FT_PIXEL_MODE_GRAY; it gives
                    the number of gray levels used in the bitmap.''')
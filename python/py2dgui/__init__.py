@@ -1,4 +1,4 @@
 from py2dgui.primitives import Triangle, Square, BorderedSquare
 from py2dgui.stage import Stage
 from py2dgui.base import Point, Color
-from py2dgui.actor import Group, ImageActor, TextActor 
\ No newline at end of file
+from py2dgui.actor import Group, ImageActor, TextActor, InstancedActor 
\ No newline at end of file
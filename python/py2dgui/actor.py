@@ -1,12 +1,32 @@
-from OpenGL.GL import   glDrawArrays,			      \
+from OpenGL.GL import   glGenVertexArrays,            \
+						glDeleteVertexArrays,         \
 						glBufferData,                 \
-						glBindTexture,                \
 						glTexImage2D,                 \
 						glPixelStorei,                \
 						glTexParameteri,              \
 						glActiveTexture,              \
 						glGenTextures,                \
 						glDeleteTextures,             \
+						glGenFramebuffers,            \
+						glBindFramebuffer,            \
+						glDeleteFramebuffers,         \
+						glFramebufferTexture2D,       \
+						glCheckFramebufferStatus,     \
+						glClearBufferfv,              \
+						glGetIntegerv,                \
+						glViewport,                   \
+						glBlendFunc,                  \
+						glBlendFuncSeparate,          \
+						GL_FRAMEBUFFER,               \
+						GL_FRAMEBUFFER_BINDING,       \
+						GL_FRAMEBUFFER_COMPLETE,      \
+						GL_COLOR_ATTACHMENT0,         \
+						GL_COLOR,                     \
+						GL_VIEWPORT,                  \
+						GL_MAX_TEXTURE_SIZE,          \
+						GL_ONE,                       \
+						GL_SRC_ALPHA,                 \
+						GL_ONE_MINUS_SRC_ALPHA,       \
 						GL_TEXTURE0,                  \
 						GL_TRIANGLES,		          \
 						GL_ARRAY_BUFFER,              \
@@ -16,21 +36,42 @@ from OpenGL.GL import   glDrawArrays,			      \
        					GL_TEXTURE_MIN_FILTER,        \
        					GL_TEXTURE_MAG_FILTER,        \
        					GL_LINEAR,                    \
+       					GL_TEXTURE_WRAP_S,            \
+       					GL_TEXTURE_WRAP_T,            \
+       					GL_CLAMP_TO_EDGE,             \
        					GL_RGB,                       \
        					GL_RGBA
 				
 									
 from OpenGL.arrays import vbo   
-from numpy import array
+from numpy import array, zeros, ones, concatenate, frombuffer, where, arange, cumsum, maximum, column_stack, empty, \
+				  identity
+from numpy.linalg import inv, LinAlgError
+from math import floor, ceil
 
 import Image
+import weakref
 
-from py2dgui.base import Point, Color
-from py2dgui.atlas import Atlas
+from py2dgui.base import Point, Color, transformMatrix, transformMatrices, \
+						 transformBounds, pointsBounds, unionBounds, \
+						 pointInTriangles, trianglesIntersectBounds, projectionMatrix
+from py2dgui.atlas import getAtlas, releaseAtlas
+from py2dgui.shaders import getShaderClass, renderState
+from py2dgui.trace import tracer
 #from OpenGL.raw.GL.annotations import glGenTextures
 
 
 
+def _pointsFromXY(data):
+	'''
+	Returns (x, y, 0, 1) points from the first two columns of data
+	'''
+	points = zeros((len(data), 4), 'f')
+	points[:,:2] = data[:,:2]
+	points[:,3] = 1
+	return points
+
+
 
 						
 class BaseActor(object):
@@ -43,8 +84,12 @@ class BaseActor(object):
 	
 	def __init__(self):
 		
-		# Place holder for VBO object
+		# Place holder for VBO and VAO objects
 		self.vbo = None
+		self.vao = None
+		
+		# Context the OpenGL objects are made in
+		self.glContext = renderState.context
 		
 		# Is the VBO ready to render with current data
 		self.ready = False
@@ -55,18 +100,48 @@ class BaseActor(object):
 		self._scale = Point(1,1,1)
 		
 		# Animatable alpha channel
-		self.alpha = 1.0
+		self._alpha = 1.0
 		
-		# Matrix from model to camera (provided in _render)
-		self.matrixStack = None
-		self.modelCameraMatrix = None
+		# Depth from the position in the draw order (provided by the stage)
+		self.depth = 0.0
 		
-		# Projection matrix
-		self.projection_matrix = None
+		# Cached transformation matrices (None when they need rebuilding)
+		self._localMatrix = None
+		self._worldMatrix = None
+		
+		# Cached bounding boxes (None when they need rebuilding)
+		self._localBounds = None # Our own geometry, in local space
+		self._worldBounds = None # Our own geometry, in camera space
+		self._bounds = None      # Ourselves and all descendants, in camera space
+		self._boundsValid = False
+		
+		# Cached camera space triangles (used for hit testing)
+		self._worldTriangles = None
+		
+		# Matrix from model to camera (provided in _applyTransform)
+		self.modelCamera_matrix = None
 		
 		# Child actors
 		self.children = []
 		
+		# Weak reference to the parent actor
+		self.parent = None
+		
+		# Weak reference to the stage this actor is on
+		self._stage = None
+		
+		# Draw layer (None to use the layer of the parent)
+		self._layer = None
+		
+		# Is this actor drawn from a cached texture, and is the texture
+		# out of date (see Group.setCacheAsTexture)
+		self._cacheAsTexture = False
+		self._cacheDirty = False
+		
+		# Is the geometry of the PrimitiveActors below this actor baked
+		# into one buffer (see Group.freeze)
+		self._frozen = False
+		
 		# Safety flags
 		self.preRenderRan = False
 		self.postRenderRan = True
@@ -74,28 +149,288 @@ class BaseActor(object):
 		
 	def translate(self, value):
 		self._translation = value
+		self._invalidateTransform()
 		
 	def getTranslation(self):
 		return self._translation
 		
 	def rotate(self, value):
 		self._rotation = value
+		self._invalidateTransform()
 		
 	def getRotation(self):
 		return self._rotation
 	
 	def scale(self, value):
 		self._scale = value
+		self._invalidateTransform()
 	
 	def getScale(self):
 		return self._scale
 		
+	def _setAlpha(self, alpha):
+		self._alpha = alpha
+		self._invalidateCaches()
+		self._markChanged()
+		
+	alpha = property(lambda self: self._alpha, _setAlpha)
+		
+	def setLayer(self, layer):
+		'''
+		Set the layer of this actor and its descendants (actors in higher
+		layers are drawn over those in lower ones, whatever their position
+		in the tree). None uses the layer of the parent
+		'''
+		self._layer = layer
+		stage = self.getStage()
+		if stage is not None:
+			stage._orderChanged()
+			
+	def getLayer(self):
+		return self._layer
+		
 	def addChild(self, child):
 		self.children.append(child)
+		child.parent = weakref.ref(self)
+		child._invalidateWorld()
+		child._setStage(self.getStage())
+		child._invalidateCaches()
+		self._invalidateBounds()
 		
 	def removeChild(self, child):
 		if child in self.children:
+			child._invalidateCaches()
 			self.children.remove(child)
+			child.parent = None
+			child._invalidateWorld()
+			child._setStage(None)
+			self._invalidateBounds()
+			
+	def getParent(self):
+		'''
+		Returns the parent actor, or None
+		'''
+		if self.parent is None:
+			return None
+		return self.parent()
+		
+	def getStage(self):
+		'''
+		Returns the stage this actor is on (or None)
+		'''
+		if self._stage is None:
+			return None
+		return self._stage()
+		
+	def _setStage(self, stage):
+		'''
+		Attach this actor and its descendants to a stage
+		(or detach them if stage is None)
+		'''
+		old = self.getStage()
+		if old is stage:
+			return
+		if old is not None:
+			old._detachActor(self)
+		if stage is None:
+			self._stage = None
+		else:
+			self._stage = weakref.ref(stage)
+			stage._attachActor(self)
+		for child in self.children:
+			child._setStage(stage)
+			
+	def _markMoved(self):
+		'''
+		Tell the stage our world bounds changed
+		'''
+		stage = self.getStage()
+		if stage is not None:
+			stage._actorMoved(self)
+			
+	def _markChanged(self):
+		'''
+		Tell the stage how we look changed (but not where we are)
+		'''
+		stage = self.getStage()
+		if stage is not None:
+			stage._actorChanged(self)
+		
+		
+	def _invalidateTransform(self):
+		'''
+		Mark the local matrix of this actor as needing to be rebuilt
+		'''
+		self._localMatrix = None
+		self._invalidateWorld()
+		
+		# Our ancestors' bounds include ours
+		parent = self.getParent()
+		if parent is not None:
+			parent._invalidateBounds()
+		self._invalidateCaches()
+		
+	def _invalidateWorld(self):
+		'''
+		Mark the world matrix of this actor and all of its
+		descendants as needing to be rebuilt
+		'''
+		# Descendants are always invalidated along with us, so if our
+		# matrix is already invalid there is nothing left to do
+		if self._worldMatrix is None:
+			return
+		self._worldMatrix = None
+		self._worldBounds = None
+		self._worldTriangles = None
+		self._boundsValid = False
+		self._markMoved()
+		for child in self.children:
+			child._invalidateWorld()
+			
+	def _invalidateGeometry(self):
+		'''
+		Mark the local bounds of this actor as needing to be rebuilt
+		(called when the vertex data changes)
+		'''
+		self._localBounds = None
+		self._worldBounds = None
+		self._worldTriangles = None
+		self._invalidateBounds()
+		self._markMoved()
+		self._invalidateCaches()
+		
+	def _invalidateCaches(self):
+		'''
+		Mark the cached textures of the groups above this actor as out of
+		date (called when anything that changes how we look changes)
+		'''
+		actor = self.getParent()
+		while actor is not None:
+			if actor._cacheAsTexture:
+				# The texture covers all the descendants of the group
+				actor._cacheDirty = True
+				actor._localBounds = None
+				actor._worldBounds = None
+				actor._invalidateBounds()
+				actor._markMoved()
+			actor = actor.getParent()
+		
+	def _invalidateBounds(self):
+		'''
+		Mark the bounds of this actor and its ancestors as
+		needing to be rebuilt
+		'''
+		actor = self
+		while actor is not None and actor._boundsValid:
+			actor._boundsValid = False
+			actor = actor.getParent()
+			
+	def _computeLocalBounds(self):
+		'''
+		Returns the bounding box of this actor's own geometry in local space
+		(should be overridden by child classes that have geometry)
+		'''
+		return None
+		
+	def getLocalBounds(self):
+		'''
+		Returns the bounding box (xmin, ymin, xmax, ymax) of this actor's
+		own geometry in local space, or None if it has none
+		'''
+		if self._localBounds is None:
+			self._localBounds = self._computeLocalBounds() or ()
+		return self._localBounds or None
+		
+	def getWorldBounds(self):
+		'''
+		Returns the bounding box of this actor's own geometry in camera space
+		'''
+		if self._worldBounds is None:
+			self._worldBounds = transformBounds(self.getWorldMatrix(), self.getLocalBounds()) or ()
+		return self._worldBounds or None
+		
+	def _getSubtreeBounds(self, matrix):
+		'''
+		Returns the bounding box of this actor and all of its descendants,
+		with matrix applied to this actor's local space
+		'''
+		bounds = transformBounds(matrix, self.getLocalBounds())
+		for child in self.children:
+			bounds = unionBounds(bounds, child._getSubtreeBounds(matrix.dot(child.getLocalMatrix())))
+		return bounds
+		
+	def getBounds(self):
+		'''
+		Returns the bounding box of this actor and all of its
+		descendants in camera space, or None if none have geometry
+		'''
+		if not self._boundsValid:
+			bounds = self.getWorldBounds()
+			for child in self.children:
+				bounds = unionBounds(bounds, child.getBounds())
+			self._bounds = bounds
+			self._boundsValid = True
+		return self._bounds
+			
+	def _computeTriangles(self):
+		'''
+		Returns the triangles drawn by this actor in local space, as an
+		array of points of shape (n, 3, 4), or None if it draws nothing
+		(should be overridden by child classes that have geometry)
+		'''
+		return None
+		
+	def getWorldTriangles(self):
+		'''
+		Returns the triangles drawn by this actor (but not its children)
+		in camera space, as an array of shape (n, 3, 2)
+		'''
+		if self._worldTriangles is None:
+			triangles = self._computeTriangles()
+			if triangles is None:
+				self._worldTriangles = zeros((0, 3, 2), 'f')
+			else:
+				self._worldTriangles = triangles.dot(self.getWorldMatrix().T)[:,:,:2]
+		return self._worldTriangles
+		
+	def containsPoint(self, x, y):
+		'''
+		Returns True if this actor (but not its children) draws
+		over the camera space point x, y
+		'''
+		bounds = self.getWorldBounds()
+		if bounds is None or x < bounds[0] or x > bounds[2] or y < bounds[1] or y > bounds[3]:
+			return False
+		return bool(pointInTriangles(self.getWorldTriangles(), x, y).any())
+		
+	def intersectsBounds(self, bounds):
+		'''
+		Returns True if this actor (but not its children) draws inside
+		the camera space bounding box (xmin, ymin, xmax, ymax)
+		'''
+		return bool(trianglesIntersectBounds(self.getWorldTriangles(), bounds).any())
+		
+		
+	def getLocalMatrix(self):
+		'''
+		Returns the matrix for this actor's own transformations
+		'''
+		if self._localMatrix is None:
+			self._localMatrix = transformMatrix(self._translation, self._rotation, self._scale)
+		return self._localMatrix
+		
+	def getWorldMatrix(self):
+		'''
+		Returns the model to camera matrix for this actor
+		(its own transformations combined with those of its ancestors)
+		'''
+		if self._worldMatrix is None:
+			parent = self.getParent()
+			if parent is None:
+				self._worldMatrix = self.getLocalMatrix()
+			else:
+				self._worldMatrix = parent.getWorldMatrix().dot(self.getLocalMatrix())
+		return self._worldMatrix
 			
 		
 	def _assignVBO(self, a):
@@ -103,53 +438,66 @@ class BaseActor(object):
 		Assign the data in the VBO for this object
 		'''
 			
+		# Keep a copy of the vertex data
+		self.data = array(a, 'f')
+		
 		# Assign VBO
-		self.vbo = vbo.VBO(
-						   array(a, 'f')
-						   )
+		self.vbo = vbo.VBO(self.data)
+		
+		self._assignVAO()
+		
+	def _assignVAO(self):
+		'''
+		Build the VAO for this object
+		'''
+		# Build the VAO once, so rendering only needs to bind it
+		self.vao = glGenVertexArrays(1)
+		renderState.bindVertexArray(self.vao)
+		self.vbo.bind()
+		getShaderClass(self.actortype).setupAttributes(self)
+		renderState.bindVertexArray(0)
+		self.vbo.unbind()
+		
 		# Setup is complete
 		self.ready = True 
 			
-	def _prerender(self, stage, projection_matrix, matrixStack):
+	def _applyTransform(self):
+		'''
+		Assign the matrix used to render this actor
+		'''
+		# Get the (cached) camera2model matrix for this actor
+		self.modelCamera_matrix = self.getWorldMatrix()
+		
+	def _prerender(self, stage):
 		'''
 		Sets up the OpenGL environment to render this actor
 		returns the shader used
 		'''
 		# Check flags
 		if self.postRenderRan != True:
-			raise Exception("_postrender was not called after previous _render")
+			raise Exception("_postrender was not called after previous _draw")
 		# reset flag for postrender
 		self.postRenderRan = False
 		
 		# Check if this object has been setup yet
 		if not self.ready:
-			raise Exception("_render called before _assignVBO")
-				
-		# Push the current state of the matrix stack before we start changing things
-		self.matrixStack = matrixStack 
-		self.matrixStack.push()
+			raise Exception("_draw called before _assignVBO")
 		
-		# Apply transformations
-		self.matrixStack.translate(self.getTranslation())
-		self.matrixStack.rotatex(self.getRotation().x)
-		self.matrixStack.rotatey(self.getRotation().y)
-		self.matrixStack.rotatez(self.getRotation().z)
-		self.matrixStack.scale(self.getScale())	
-		
-		# Calculate the camera2model matrix for this actor
-		self.modelCamera_matrix = self.matrixStack.top()
-		
-		# Assign the projection matrix
-		self.projection_matrix = projection_matrix
+		# Anything still waiting in the primitive batch has to be drawn first
+		stage.flushBatch()
+				
+		# Apply the transformations for this actor
+		self._applyTransform()
 		
 		# Get the correct shader from the stage
 		shader = stage.getShader(self.actortype)
 		
-		# Bind the VBO 
-		self.vbo.bind()
+		# Bind the VAO 
+		renderState.bindVertexArray(self.vao)
 		
 		# Run the setup for the shader
-		shader.setup(self)
+		with tracer.span('shader setup', self.actortype):
+			shader.setup(self)
 		
 		# set this flag to say the prerender ran
 		self.preRenderRan = True
@@ -157,13 +505,63 @@ class BaseActor(object):
 		return shader
 
 
-	def _render(self, stage, projection_matrix, modelCamera_matrix):
+	def _update(self):
+		'''
+		Bring the buffers of this actor up to date before it is drawn
+		'''
+		pass
+		
+	def _getStateKey(self, stage):
+		'''
+		Returns the (shader, texture, buffer) used to draw this actor
 		'''
-		Render this Actor
+		return (self.actortype, 0, self.vao)
+		
+	def isOpaque(self):
+		'''
+		Returns True if every pixel this actor draws is fully opaque,
+		so it can be drawn without blending
+		'''
+		return False
+		
+	def _drawArrays(self):
+		'''
+		Issue the draw call for this actor's geometry.
+		Assumes the VAO and shader are already set up
 		(should be overridden by child classes)
 		'''
 		raise NotImplementedError
 		
+	def _draw(self, stage):
+		'''
+		Draw this actor, but not its children
+		'''
+		renderState.setActorType(self.actortype)
+		with tracer.span('update', self.actortype):
+			self._update()
+		
+		# Run the pre-render
+		with tracer.span('_prerender', self.actortype):
+			shader = self._prerender(stage)
+		
+		# Render
+		with tracer.span('draw', self.actortype):
+			self._drawArrays()
+		
+		# Post render
+		with tracer.span('_postrender', self.actortype):
+			self._postrender(stage, shader)
+		
+	def _drawDescendants(self, stage):
+		'''
+		Draw the descendants of this actor in order
+		(those inside cached groups are drawn by the group)
+		'''
+		for child in self.children:
+			child._draw(stage)
+			if not child._cacheAsTexture:
+				child._drawDescendants(stage)
+		
 		
 	def _postrender(self, stage, shader):
 		'''
@@ -171,23 +569,31 @@ class BaseActor(object):
 		'''
 		#Check flags
 		if self.preRenderRan == False:
-			raise Exception("_prerender was not called before _render")
+			raise Exception("_prerender was not called before _draw")
 		# reset flag
 		self.preRenderRan = False			
 	
 		shader.cleanup()
 		
-		self.vbo.unbind()	
-			
-		# Render children
-		for child in self.children:
-			child._render(stage, self.projection_matrix, self.matrixStack)
-			
-		# Pop the matrix stack back to what it was
-		self.matrixStack.pop()
-		
 		# Set this flag to say the postrender ran
 		self.postRenderRan = True
+		
+	def release(self):
+		'''
+		Delete the OpenGL objects of this actor
+		(the actor can't be rendered afterwards)
+		'''
+		if self.vao:
+			glDeleteVertexArrays(1, [self.vao])
+			renderState.invalidate()
+			self.vao = None
+			self.ready = False
+			
+	def __del__(self):
+		# Only while the actor's context is current, objects deleted
+		# after it was destroyed (or during shutdown) just go with it
+		if renderState.owns(self.glContext):
+			self.release()
 
 
 
@@ -210,6 +616,12 @@ class PrimitiveActor(BaseActor):
 		# Default color
 		self.default_color = color
 		
+		# Camera space copy of the vertex data (used by the PrimitiveBatch)
+		self._batchMatrix = None
+		self._batchAlpha = None
+		self._batchDepth = None
+		self._batchData = None
+		
 		# Assign the VBO
 		self._assignVBO()
 		
@@ -243,16 +655,189 @@ class PrimitiveActor(BaseActor):
 		# Call the base method
 		super(PrimitiveActor, self)._assignVBO(a)
 		
+		
+	def getVertexData(self):
+		'''
+		Returns the (points, colors) arrays for this object
+		'''
+		n = len(self.points)
+		return self.data[:n], self.data[n:]
+		
+	def _computeLocalBounds(self):
+		return pointsBounds(self.getVertexData()[0])
+		
+	def _computeTriangles(self):
+		points = self.getVertexData()[0]
+		return points[:len(points) - len(points) % 3].reshape(-1, 3, 4)
+		
 	
-	def _render(self, stage, projection_matrix, modelCamera_matrix):
-		# Run the pre-render
-		shader = super(PrimitiveActor, self)._prerender(stage, projection_matrix, modelCamera_matrix)
+	def _draw(self, stage):
+		# Queue into the stage batch instead of drawing on our own
+		if stage.batching:
+			self._applyTransform()
+			stage.batch.add(self, self.modelCamera_matrix)
+			return
+			
+		super(PrimitiveActor, self)._draw(stage)
 		
-		# Render
-		glDrawArrays(GL_TRIANGLES, 0, len(self.vbo) / 2)
+	def isOpaque(self):
+		return self.alpha >= 1.0
 		
-		# Post render
-		super(PrimitiveActor, self)._postrender(stage, shader)
+	def _getStateKey(self, stage):
+		# Everything in the batch is drawn with the same state
+		if stage.batching:
+			return (stage.batch.actortype, 0, None)
+		return super(PrimitiveActor, self)._getStateKey(stage)
+		
+	def _drawArrays(self):
+		renderState.drawArrays(GL_TRIANGLES, 0, len(self.vbo) / 2)
+		
+
+
+
+class InstancedActor(BaseActor):
+	'''
+	Actor for many copies of a PrimitiveActor's geometry, that differ
+	only in transform, color and alpha. The geometry buffer of the
+	template is shared, and all the copies are drawn with one call
+	'''
+	# Actortype (used to determine shader)
+	actortype = 'instanced'
+	
+	def __init__(self, template):
+		super(InstancedActor, self).__init__()
+		
+		# PrimitiveActor to copy, we share its VBO
+		self.template = template
+		self.vbo = template.vbo
+		
+		# Per instance values
+		self.translations = zeros((0, 3), 'f')
+		self.rotations = zeros((0, 3), 'f')
+		self.scales = zeros((0, 3), 'f')
+		self.colors = zeros((0, 4), 'f')
+		
+		# Per instance VBO, a 4x4 matrix (column major) then a color
+		self.instanceVBO = vbo.VBO(zeros((0, 20), 'f'), usage='GL_DYNAMIC_DRAW')
+		self.instancesDirty = True
+		self._instanceMatrices = None
+		self._opaqueInstances = None
+		
+		self._assignVAO()
+		
+	def __len__(self):
+		return len(self.translations)
+		
+	def addInstance(self, translation=Point(), rotation=Point(), scale=Point(1,1,1), color=None, alpha=1.0):
+		'''
+		Add a single copy, returns its index
+		'''
+		if color is None:
+			color = self.template.default_color
+		c = array(color.data)
+		c[3] = alpha
+		return self.addInstances([translation.data[:3]], [rotation.data[:3]], [scale.data[:3]], [c])
+		
+	def addInstances(self, translations, rotations=None, scales=None, colors=None):
+		'''
+		Add copies from arrays with one row per copy (translations, rotations
+		and scales are x, y, z, colors are r, g, b, alpha).
+		Returns the index of the first copy
+		'''
+		n = len(translations)
+		if rotations is None:
+			rotations = zeros((n, 3), 'f')
+		if scales is None:
+			scales = ones((n, 3), 'f')
+		if colors is None:
+			colors = array([self.template.default_color.data] * n, 'f').reshape(n, 4)
+		
+		first = len(self)
+		self.translations = concatenate((self.translations, array(translations, 'f').reshape(n, 3)))
+		self.rotations = concatenate((self.rotations, array(rotations, 'f').reshape(n, 3)))
+		self.scales = concatenate((self.scales, array(scales, 'f').reshape(n, 3)))
+		self.colors = concatenate((self.colors, array(colors, 'f').reshape(n, 4)))
+		self._invalidateInstances()
+		return first
+		
+	def setInstances(self, start=0, translations=None, rotations=None, scales=None, colors=None):
+		'''
+		Update copies from arrays with one row per copy, starting at index start
+		'''
+		for values, target in ((translations, self.translations), (rotations, self.rotations),
+							   (scales, self.scales), (colors, self.colors)):
+			if values is not None:
+				target[start:start + len(values)] = values
+		self._invalidateInstances()
+		
+	def clearInstances(self):
+		'''
+		Remove all the copies
+		'''
+		self.translations = zeros((0, 3), 'f')
+		self.rotations = zeros((0, 3), 'f')
+		self.scales = zeros((0, 3), 'f')
+		self.colors = zeros((0, 4), 'f')
+		self._invalidateInstances()
+		
+	def _invalidateInstances(self):
+		self.instancesDirty = True
+		self._instanceMatrices = None
+		self._opaqueInstances = None
+		self._invalidateGeometry()
+		
+	def isOpaque(self):
+		if self._opaqueInstances is None:
+			self._opaqueInstances = bool((self.colors[:,3] >= 1.0).all())
+		return self.alpha >= 1.0 and self._opaqueInstances
+		
+	def _getInstanceMatrices(self):
+		if self._instanceMatrices is None:
+			self._instanceMatrices = transformMatrices(self.translations, self.rotations, self.scales)
+		return self._instanceMatrices
+		
+	def _computeLocalBounds(self):
+		bounds = self.template.getLocalBounds()
+		if bounds is None or len(self) == 0:
+			return None
+		
+		# Transform the corners of the template by every instance matrix
+		x0, y0, x1, y1 = bounds
+		corners = array([[x0, y0, 0, 1], [x1, y0, 0, 1], [x1, y1, 0, 1], [x0, y1, 0, 1]], 'f')
+		points = self._getInstanceMatrices().dot(corners.T).transpose(0, 2, 1)
+		return pointsBounds(points.reshape(-1, 4))
+		
+	def _computeTriangles(self):
+		triangles = self.template._computeTriangles()
+		if len(self) == 0 or len(triangles) == 0:
+			return None
+		
+		# A copy of the template triangles for every instance
+		points = self._getInstanceMatrices().dot(triangles.reshape(-1, 4).T).transpose(0, 2, 1)
+		return points.reshape(-1, 3, 4)
+		
+		
+	def _uploadInstances(self):
+		'''
+		Write the per instance values to the instance VBO
+		'''
+		matrices = self._getInstanceMatrices()
+		
+		a = zeros((len(self), 20), 'f')
+		a[:,:16] = matrices.transpose(0, 2, 1).reshape(-1, 16)
+		a[:,16:] = self.colors
+		
+		renderState.uploadBuffer(self.instanceVBO, a)
+		self.instancesDirty = False
+		
+		
+	def _update(self):
+		if self.instancesDirty:
+			self._uploadInstances()
+			
+	def _drawArrays(self):
+		# Render every copy
+		renderState.drawArraysInstanced(GL_TRIANGLES, 0, len(self.template.points), len(self))
 		
 
 
@@ -262,32 +847,352 @@ class Group(BaseActor):
 	Actor for groups of other actors
 	'''	
 	actortype = 'group'
-
-	def _render(self, stage, projection_matrix, modelCamera_matrix):
+	
+	# Longest side of a cached texture (GL_MAX_TEXTURE_SIZE if that is less)
+	maxCacheSize = 4096
+	
+	def __init__(self):
+		super(Group, self).__init__()
 		
-		# Set the modelCamera_matrix
-		self.matrixStack = modelCamera_matrix 
-		self.matrixStack.push()
+		# Framebuffer and texture the descendants are cached in
+		self.fbo = None
+		self.texid = None
 		
-		# Apply transformations
-		self.matrixStack.translate(self.getTranslation())
-		self.matrixStack.rotatex(self.getRotation().x)
-		self.matrixStack.rotatey(self.getRotation().y)
-		self.matrixStack.rotatez(self.getRotation().z)
-		self.matrixStack.scale(self.getScale())	
+		# Size and corner of the area the texture covers in local space
+		self.cacheSize = (0, 0)
+		self.cacheOrigin = (0, 0)
 		
-		# Calculate the camera2model matrix for this actor
-		self.modelCamera_matrix = self.matrixStack.top()
+		# Size of the texture (smaller than the area when a side is
+		# longer than maxCacheSize)
+		self.cacheTextureSize = (0, 0)
 		
-		# Assign the projection matrix
-		self.projection_matrix = projection_matrix
+		# Baked geometry of the frozen group
+		self.frozenData = None
+		self.frozenVBO = None
+		self.frozenVAO = None
 		
-		# Render children
-		for child in self.children:
-			child._render(stage, self.projection_matrix, self.matrixStack)
+		
+	def setCacheAsTexture(self, enabled):
+		'''
+		Draw the descendants of this group into a texture once, then draw
+		the texture as a single quad until one of them changes. Transforms
+		of the group itself reuse the texture, which has one texel per unit
+		of the group's local space (so it is blurred if the group is scaled up),
+		or fewer along sides longer than maxCacheSize.
+		The texture holds premultiplied colors, and is drawn with the
+		group's alpha
+		'''
+		enabled = bool(enabled)
+		if enabled == self._cacheAsTexture:
+			return
+		self._cacheAsTexture = enabled
+		self._cacheDirty = enabled
+		if not enabled:
+			self._deleteCache()
+			
+		# Our geometry is now the quad (or nothing)
+		self._invalidateGeometry()
+		stage = self.getStage()
+		if stage is not None:
+			stage._orderChanged()
+			
+	def getCacheAsTexture(self):
+		return self._cacheAsTexture
+		
+		
+	def freeze(self):
+		'''
+		Bake the geometry of the PrimitiveActors below this group into one
+		buffer, with their transforms (relative to the group), colors and
+		alpha applied, so they are all drawn with a single call. Changes to
+		the baked actors aren't shown until the group is thawed (transforms
+		of the group itself still are). Other actors are still drawn on
+		their own, over the baked geometry
+		'''
+		if self._frozen:
+			self.thaw()
+			
+		parts = []
+		self._bake(self, identity(4, 'f'), parts)
+		if parts == []:
+			return
+		
+		self.frozenData = concatenate(parts)
+		self.frozenVBO = vbo.VBO(self.frozenData)
+		self.frozenVAO = glGenVertexArrays(1)
+		renderState.bindVertexArray(self.frozenVAO)
+		self.frozenVBO.bind()
+		getShaderClass('frozengroup').setupAttributes(self)
+		renderState.bindVertexArray(0)
+		self.frozenVBO.unbind()
+		
+		self._frozen = True
+		self._frozenChanged()
+		
+	def _bake(self, actor, matrix, parts):
+		'''
+		Add the baked vertices of the PrimitiveActors below actor to parts
+		(matrix is from actor's local space to ours)
+		'''
+		for child in actor.children:
+			childMatrix = matrix.dot(child.getLocalMatrix())
+			if child.actortype == 'primitive':
+				points, colors = child.getVertexData()
+				data = empty((len(points), 8), 'f')
+				data[:,:4] = points.dot(childMatrix.T)
+				data[:,4:] = colors
+				
+				# The primitive shader uses the actor alpha for every vertex
+				data[:,7] = child.alpha
+				parts.append(data)
+				
+			# Cached and frozen groups draw their own descendants
+			if not child._cacheAsTexture and not child._frozen:
+				self._bake(child, childMatrix, parts)
+				
+	def thaw(self):
+		'''
+		Go back to drawing the baked actors individually
+		'''
+		if not self._frozen:
+			return
+		glDeleteVertexArrays(1, [self.frozenVAO])
+		renderState.invalidate()
+		self.frozenData = None
+		self.frozenVBO = None
+		self.frozenVAO = None
+		
+		self._frozen = False
+		self._frozenChanged()
+		
+	def isFrozen(self):
+		return self._frozen
+		
+	def _frozenChanged(self):
+		self._invalidateGeometry()
+		stage = self.getStage()
+		if stage is not None:
+			stage._orderChanged()
+			
+			
+	def _computeLocalBounds(self):
+		if self._cacheAsTexture:
+			# The texture covers all of the descendants
+			bounds = None
+			for child in self.children:
+				bounds = unionBounds(bounds, child._getSubtreeBounds(child.getLocalMatrix()))
+			return bounds
+		
+		if self._frozen:
+			return pointsBounds(self.frozenData)
+		return None
+		
+	def isOpaque(self):
+		if self._cacheAsTexture or not self._frozen:
+			return False
+		return self.alpha >= 1.0 and bool((self.frozenData[:,7] >= 1.0).all())
+		
+	def _drawDescendants(self, stage):
+		if not self._frozen:
+			super(Group, self)._drawDescendants(stage)
+			return
+		
+		self._drawUnbaked(self, stage)
+		
+	def _drawUnbaked(self, actor, stage):
+		'''
+		Draw the descendants of actor that weren't baked, our baked
+		geometry (drawn by _draw) replaces the PrimitiveActors at any
+		depth (follows the same path as _bake)
+		'''
+		for child in actor.children:
+			if child.actortype != 'primitive':
+				child._draw(stage)
+			if child._cacheAsTexture:
+				continue
+			if child._frozen:
+				child._drawDescendants(stage)
+			else:
+				self._drawUnbaked(child, stage)
+				
+	def _drawFrozen(self, stage):
+		'''
+		Draw the baked geometry
+		'''
+		stage.flushBatch()
+		shader = stage.getShader('frozengroup')
+		renderState.bindVertexArray(self.frozenVAO)
+		shader.setup(self)
+		renderState.drawArrays(GL_TRIANGLES, 0, len(self.frozenData))
+		shader.cleanup()
+		
+		
+	def _renderCache(self, stage):
+		'''
+		Draw the descendants of this group into the cached texture
+		'''
+		self._cacheDirty = False
+		bounds = self.getLocalBounds()
+		if bounds is None:
+			self._deleteCache()
+			return
+		
+		# Texel aligned area covering the bounds
+		x0 = floor(bounds[0])
+		y0 = floor(bounds[1])
+		w = max(int(ceil(bounds[2]) - x0), 1)
+		h = max(int(ceil(bounds[3]) - y0), 1)
+		
+		# The descendants are drawn with their camera space matrices, so
+		# the projection has to undo ours
+		try:
+			inverse = inv(self.getWorldMatrix())
+		except LinAlgError:
+			return
+		
+		# Sides longer than the largest texture get fewer texels, the
+		# projection still covers all of the bounds
+		limit = min(self.maxCacheSize, int(glGetIntegerv(GL_MAX_TEXTURE_SIZE)))
+		tw = min(w, limit)
+		th = min(h, limit)
+		
+		# Save the bindings before the cache framebuffer is bound
+		previous = glGetIntegerv(GL_FRAMEBUFFER_BINDING)
+		viewport = glGetIntegerv(GL_VIEWPORT)
+		
+		if self.fbo is None:
+			self.fbo = glGenFramebuffers(1)
+			self.texid = glGenTextures(1)
 			
-		# Pop the matrix stack back to what it was
-		self.matrixStack.pop()
+		if (tw, th) != self.cacheTextureSize:
+			renderState.bindTexture(self.texid)
+			glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+			glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+			
+			# Clamp so linear filtering doesn't wrap around at the edges of the quad
+			glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+			glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+			glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, tw, th, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+			
+			glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+			glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texid, 0)
+			complete = glCheckFramebufferStatus(GL_FRAMEBUFFER) == GL_FRAMEBUFFER_COMPLETE
+			
+			# Leave the stage's framebuffer bound if this fails
+			glBindFramebuffer(GL_FRAMEBUFFER, previous)
+			if not complete:
+				self._deleteCache()
+				raise Exception("Could not create the framebuffer for a cached group")
+			self.cacheTextureSize = (tw, th)
+				
+		if ((x0, y0), (w, h)) != (self.cacheOrigin, self.cacheSize):
+			self.cacheOrigin = (x0, y0)
+			self.cacheSize = (w, h)
+			self._assignQuad()
+			
+		glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+		glViewport(0, 0, tw, th)
+		glClearBufferfv(GL_COLOR, 0, zeros(4, 'f'))
+		
+		projection = projectionMatrix(w, h).dot(transformMatrix(Point(-x0, -y0), Point(), Point(1, 1, 1))).dot(inverse)
+		stage.frameUniforms.setProjection(projection)
+		stage.frameUniforms.upload()
+		
+		# Blend the alpha as well, so the texture holds premultiplied colors
+		glBlendFuncSeparate(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA, GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+		if self._frozen:
+			self._applyTransform()
+			self._drawFrozen(stage)
+		self._drawDescendants(stage)
+		stage.flushBatch()
+		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+		
+		stage.frameUniforms.setProjection(stage.projection_matrix)
+		stage.frameUniforms.upload()
+		glBindFramebuffer(GL_FRAMEBUFFER, previous)
+		glViewport(*viewport)
+		
+		
+	def _assignQuad(self):
+		'''
+		Build the quad the cached texture is drawn on
+		'''
+		x0, y0 = self.cacheOrigin
+		x1 = x0 + self.cacheSize[0]
+		y1 = y0 + self.cacheSize[1]
+		a = array([x0, y0, 0, 0,  x1, y0, 1, 0,  x1, y1, 1, 1,
+				   x0, y0, 0, 0,  x1, y1, 1, 1,  x0, y1, 0, 1], 'f')
+				   
+		if self.vao is None:
+			self.vbo = vbo.VBO(a)
+			self.vao = glGenVertexArrays(1)
+			renderState.bindVertexArray(self.vao)
+			self.vbo.bind()
+			getShaderClass('groupcache').setupAttributes(self)
+			renderState.bindVertexArray(0)
+			self.vbo.unbind()
+		else:
+			renderState.uploadBuffer(self.vbo, a)
+			
+			
+	def _deleteCache(self):
+		'''
+		Delete the cached texture
+		'''
+		if self.fbo is not None:
+			glDeleteFramebuffers(1, [self.fbo])
+			glDeleteTextures([self.texid])
+			self.fbo = None
+			self.texid = None
+		if self.vao is not None:
+			glDeleteVertexArrays(1, [self.vao])
+			self.vao = None
+			self.vbo = None
+		self.cacheSize = (0, 0)
+		self.cacheTextureSize = (0, 0)
+		renderState.invalidate()
+		
+		
+	def _getStateKey(self, stage):
+		if self._cacheAsTexture:
+			return ('groupcache', self.texid, self.vao)
+		return ('frozengroup', 0, self.frozenVAO)
+		
+
+	def _draw(self, stage):
+		renderState.setActorType(self.actortype)
+		
+		# Apply the transformations for this group
+		self._applyTransform()
+		
+		if not self._cacheAsTexture:
+			if self._frozen:
+				self._drawFrozen(stage)
+			return
+		
+		if self.vao is None:
+			return
+		
+		# Draw the cached texture
+		stage.flushBatch()
+		shader = stage.getShader('groupcache')
+		renderState.bindVertexArray(self.vao)
+		shader.setup(self)
+		
+		# The texture holds premultiplied colors
+		glBlendFunc(GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+		renderState.drawArrays(GL_TRIANGLES, 0, 6)
+		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+		
+		shader.cleanup()
+		
+	def release(self):
+		self._deleteCache()
+		if self.frozenVAO is not None:
+			glDeleteVertexArrays(1, [self.frozenVAO])
+			renderState.invalidate()
+			self.frozenVAO = None
+		super(Group, self).release()
 
 		
 
@@ -303,83 +1208,138 @@ class TextActor(BaseActor):
 	def __init__(self, fontfile, size, text="", color=Color(1, 1, 1, 1)):
 		super(TextActor, self).__init__()
 		
-		# Text to render
-		self.text = text
+		# Text to render (setting it marks the vertex data as dirty)
+		self._text = text
+		self._textDirty = False
 				
 		# Text color
-		self.color = color
+		self._color = color
 		
-		# Create an OpenGL bitmap texture atlas of ascii glyphs  
-		self.atlas = Atlas(fontfile, size)
+		# Get the (shared) OpenGL bitmap texture atlas of glyphs  
+		self.atlas = getAtlas(fontfile, size)
 		
 		a = self._getVertexData()		
 		# Assign the VBO
 		super(TextActor, self)._assignVBO(a)
 		
+		
+	def _setText(self, text):
+		if text != self._text:
+			self._text = text
+			self._textDirty = True
+			self._invalidateGeometry()
+		
+	text = property(lambda self: self._text, _setText)
+	
+	def _setColor(self, color):
+		self._color = color
+		self._invalidateCaches()
+		self._markChanged()
+		
+	color = property(lambda self: self._color, _setColor)
 	
 		
 	def _getVertexData(self):
 		'''
 		Get the vertex data for this object
 		'''
-				
 		a = self.atlas
-		# All text objects are made at the origin
-		x = 0
-		y = 0
-				
-		coords = []
-		for p in self.text:
-			if p == '\n':
-				y -= a.size
-				x = 0
-				continue
-			
-			if p not in a.c:
-				p = '!'
-				
-			# Get char positions from charinfo
-			x2 = float(x) +  a.c[p].bl
-			y2 = float(-y) - a.c[p].bt
-			w = a.c[p].bw
-			h = a.c[p].bh
-			
-			# Advance cursor to the start of the next character
-			x += a.c[p].ax
-			y += a.c[p].ay
-			
-			# Skip glyphs that have no pixels
-			if w == 0 or h == 0:
-				continue
-			
-			# Create points X, Y, Z, W
-			# X and Y are for the quad, Z/W are for the texture map
-			# These are split up in the vertex shader
-			# There are 6 points here, to make 2 tris 
-			coords.extend([x2    , -y2    , a.c[p].tx                           , a.c[p].ty            ]) 
-			coords.extend([x2 + w, -y2    , a.c[p].tx + (a.c[p].bw / float(a.w)), a.c[p].ty            ])
-			coords.extend([x2    , -y2 - h, a.c[p].tx						    , a.c[p].ty + (a.c[p].bh / a.h)])
-			coords.extend([x2 + w, -y2    , a.c[p].tx + (a.c[p].bw / float(a.w)), a.c[p].ty           ])
-			coords.extend([x2    , -y2 - h, a.c[p].tx						    , a.c[p].ty + (a.c[p].bh / a.h)])
-			coords.extend([x2 + w, -y2 - h, a.c[p].tx + (a.c[p].bw / float(a.w)), a.c[p].ty + (a.c[p].bh / a.h)])
-			
-		return coords
+		
+		# Code point of each character
+		if self.text == "":
+			codes = zeros(0, int)
+		elif isinstance(self.text, unicode):
+			codes = frombuffer(self.text.encode('utf-32-le'), '<u4').astype(int)
+		else:
+			codes = frombuffer(self.text, 'u1').astype(int)
+		
+		newline = codes == ord('\n')
+		codes[newline] = ord(' ')
+		
+		# Get the atlas slot of each glyph (rasterizing any new ones)
+		slots = a.getGlyphs(codes)
+		self._slots = slots
+		self._atlasGeneration = a.generation
+		
+		# Newlines don't advance the cursor
+		advance = a.advance[slots]
+		advance[newline] = 0
+		
+		# All text objects are made at the origin. The cursor position of each
+		# character is the sum of the advances before it, restarted after each newline
+		x = cumsum(advance[:,0]) - advance[:,0]
+		lineStart = maximum.accumulate(where(newline, arange(len(codes)), 0))
+		x -= x[lineStart]
+		y = cumsum(advance[:,1]) - advance[:,1] - cumsum(newline) * a.size
+		
+		# Skip newlines and glyphs that have no pixels
+		size = a.bitmapSize[slots]
+		keep = ~newline & (size[:,0] != 0) & (size[:,1] != 0)
+		slots, x, y, size = slots[keep], x[keep], y[keep], size[keep]
+		
+		# Get char positions from the atlas
+		left = x + a.bearing[slots,0]
+		top = y + a.bearing[slots,1]
+		right = left + size[:,0]
+		bottom = top - size[:,1]
+		tex = a.getTexcoords(slots)
+		
+		# Create points X, Y, Z, W
+		# X and Y are for the quad, Z/W are for the texture map
+		# These are split up in the vertex shader
+		# There are 6 points per glyph, to make 2 tris 
+		corners = [0, 1, 0, 1, 0, 1], [0, 0, 1, 0, 1, 1]
+		coords = empty((len(slots), 6, 4), 'f')
+		coords[:,:,0] = column_stack((left, right))[:,corners[0]]
+		coords[:,:,1] = column_stack((top, bottom))[:,corners[1]]
+		coords[:,:,2] = tex[:,[0, 2]][:,corners[0]]
+		coords[:,:,3] = tex[:,[1, 3]][:,corners[1]]
+		
+		return coords.reshape(-1, 4)
 				
 
 		
-	def _render(self, stage, projection_matrix, modelCamera_matrix):
-		# Run the pre-render
-		shader = super(TextActor, self)._prerender(stage, projection_matrix, modelCamera_matrix)
-		
-		# Update the values in the VBO
-		a = self._getVertexData()
-		self.vbo.set_array(array(a, 'f'))
+	def _layout(self):
+		'''
+		Update the values in the VBO if the text changed, or the atlas moved
+		our glyphs (the data is uploaded when it is bound, the VAO keeps
+		pointing at the same buffer)
+		'''
+		if self._textDirty or self._atlasGeneration != self.atlas.generation:
+			self.data = self._getVertexData()
+			renderState.uploadBuffer(self.vbo, self.data)
+			self._textDirty = False
+			return True
+		return False
+		
+	def _computeLocalBounds(self):
+		self._layout()
+		return pointsBounds(self.data)
+		
+	def _computeTriangles(self):
+		self._layout()
+		return _pointsFromXY(self.data).reshape(-1, 3, 4)
+				
+	def _update(self):
+		if not self._layout():
+			# Keep our glyphs from being evicted
+			self.atlas.touch(self._slots)
+			
+	def _getStateKey(self, stage):
+		return (self.actortype, self.atlas.texid, self.vao)
 		
-		# Render
-		glDrawArrays(GL_TRIANGLES, 0, len(self.vbo) / 4)
+	def _drawArrays(self):
+		renderState.drawArrays(GL_TRIANGLES, 0, len(self.vbo))
 		
-		# Post render
-		super(TextActor, self)._postrender(stage, shader)
+	def release(self):
+		'''
+		Release the glyph atlas used by this actor, and delete
+		its OpenGL objects (the actor can't be rendered afterwards)
+		'''
+		if self.atlas is not None:
+			releaseAtlas(self.atlas)
+			self.atlas = None
+		super(TextActor, self).release()
 
 		
 class ImageActor(BaseActor):
@@ -403,14 +1363,15 @@ class ImageActor(BaseActor):
 		glActiveTexture(GL_TEXTURE0) 
 		self.texid = glGenTextures(1)
 		# Bind the texture
-		glBindTexture(GL_TEXTURE_2D, self.texid)
+		renderState.bindTexture(self.texid)
 		glPixelStorei(GL_UNPACK_ALIGNMENT,1)
 		
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
 		
 		# Upload the image
-		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, ix, iy, 0, GL_RGBA, GL_UNSIGNED_BYTE, image)
+		with tracer.span('texture upload', self.actortype):
+			glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, ix, iy, 0, GL_RGBA, GL_UNSIGNED_BYTE, image)
 		
 		# Generate the points for the billboard
 		if points == []:
@@ -432,19 +1393,29 @@ class ImageActor(BaseActor):
 		
 		self.alpha = float(alpha)
 		
+	def _computeLocalBounds(self):
+		return pointsBounds(self.data.reshape(-1, 4))
+		
+	def _computeTriangles(self):
+		return _pointsFromXY(self.data.reshape(-1, 4)).reshape(-1, 3, 4)
+		
 	
 	
-	def _render(self, stage, projection_matrix, modelCamera_matrix):
-		# Run the pre-render
-		shader = super(ImageActor, self)._prerender(stage, projection_matrix, modelCamera_matrix)
+	def isOpaque(self):
+		# The image shader ignores the alpha of the texture
+		return self.alpha >= 1.0
 		
-		# Render
-		glDrawArrays(GL_TRIANGLES, 0, len(self.vbo) / 2)
+	def _getStateKey(self, stage):
+		return (self.actortype, self.texid, self.vao)
 		
-		# Post render
-		super(ImageActor, self)._postrender(stage, shader)
+	def _drawArrays(self):
+		renderState.drawArrays(GL_TRIANGLES, 0, len(self.vbo) / 2)
 
-	def __del__(self):
-		glDeleteTextures([self.texid])
+	def release(self):
+		if self.texid is not None:
+			glDeleteTextures([self.texid])
+			renderState.invalidate()
+			self.texid = None
+		super(ImageActor, self).release()
 		
 		
@@ -1,12 +1,18 @@
-from freetype import Face, FT_LOAD_RENDER
+from freetype import Face, FT_LOAD_RENDER, FT_Exception
+
+import os
+import hashlib
+
+import numpy
+from numpy import zeros, asarray, unique, concatenate, searchsorted, minimum, where
 
 from OpenGL.GL import 	glActiveTexture,          \
 						 GL_TEXTURE0,             \
 						 GL_TEXTURE_2D,           \
-						 GL_ALPHA,                \
+						 GL_RED,                  \
+						 GL_R8,                   \
 						 GL_LINEAR,               \
 						 GL_UNSIGNED_BYTE,        \
-						 glBindTexture,           \
 						 glGenTextures,           \
 						 glTexImage2D,            \
 						 glTexSubImage2D,         \
@@ -19,14 +25,114 @@ from OpenGL.GL import 	glActiveTexture,          \
 						 GL_CLAMP_TO_EDGE,        \
 						 GL_TEXTURE_MIN_FILTER,   \
 						 GL_TEXTURE_MAG_FILTER
+
+from py2dgui.shaders import renderState
+from py2dgui.trace import tracer
 						
 						
+# Atlases that are in use, keyed by (context, font file, pixel size).
+# Textures belong to the context they were made in (see
+# RenderState.context), so each context has its own atlases
+_atlases = {}
+
+# Directory where built atlases are kept between runs (None to disable)
+_cacheDirectory = None
+
+# Bump when the cache file layout changes
+_cacheVersion = 1
+
+# Layout of the per glyph metrics in the cache
+_glyphType = numpy.dtype([
+	('codepoint', 'i4'),
+	('advance', 'f4', 2),
+	('bearing', 'f4', 2),
+	('size', 'f4', 2),
+	('position', 'f4', 2),
+	('shelf', 'i4'),
+])
+
+
+def setCacheDirectory(path):
+	'''
+	Set the directory used to cache atlases between runs.
+	Atlases found there are loaded instead of being rasterized
+	with FreeType, pass None to disable the cache
+	'''
+	global _cacheDirectory
+	_cacheDirectory = path
+
+
+def getAtlas(filename, size):
+	'''
+	Returns the shared Atlas for a font file and pixel size,
+	creating it if needed. Each call must be matched by a
+	call to releaseAtlas
+	'''
+	key = (renderState.context, os.path.abspath(filename), size)
+	
+	atlas = _atlases.get(key)
+	if atlas is None:
+		atlas = Atlas(filename, size)
+		atlas.key = key
+		_atlases[key] = atlas
+		
+	atlas.refcount += 1
+	return atlas
+
+
+def releaseAtlas(atlas):
+	'''
+	Release an Atlas returned by getAtlas. The texture is
+	freed when the last user releases it
+	'''
+	atlas.refcount -= 1
+	if atlas.refcount > 0:
+		return
+	
+	if _atlases.get(atlas.key) is atlas:
+		del _atlases[atlas.key]
+	atlas.delete()
+	
+	
+def forgetAtlases(context):
+	'''
+	Stop handing out the atlases made in a context, called when
+	the context is destroyed
+	'''
+	for key in _atlases.keys():
+		if key[0] is context:
+			del _atlases[key]
+	
 						
 
 class Atlas(object):
+	'''
+	Texture atlas of font glyphs.
+	
+	Glyphs are rasterized the first time they are used and packed into
+	shelves (rows of glyphs of similar height). When the texture is full
+	it grows, up to maxSize, after which the least recently used shelf
+	is evicted to make room.
+	
+	Glyphs are referred to by slot, the metrics of each slot are kept in
+	arrays (advance, bearing, bitmapSize, position) so strings can be laid
+	out with array operations. The generation counter is incremented
+	whenever slots or texture coordinates of existing glyphs change, so
+	users know when to lay their text out again.
+	'''
+	# Texture width, and the maximum texture height
+	width = 1024
+	maxSize = 2048
+	
+	# Space left between glyphs, to prevent bleeding when filtering
+	padding = 1
+	
+	# Flags used to rasterize glyphs
+	loadFlags = FT_LOAD_RENDER
+	
 	def __init__(self, filename, size):
 		# Size of the atlas texture
-		self.w = 0
+		self.w = self.width
 		self.h = 0
 		
 		# GL id assigned to texture buffer
@@ -36,47 +142,73 @@ class Atlas(object):
 		self.filename = filename
 		self.size = size
 		
-		# Dictionary of char to CharInfo objects
-		self.c = {}
+		# FreeType face (opened when the first glyph is rasterized)
+		self.face = None
+		
+		# Copy of the texture contents
+		self.bitmap = zeros((0, self.w), 'B')
+		
+		# Shelves, as arrays indexed by shelf
+		self.shelfY = []
+		self.shelfHeight = []
+		self.shelfX = []
+		self.shelfUsed = zeros(self.maxSize, int)
+		
+		# Glyph metrics, as arrays indexed by slot
+		self.advance = zeros((0, 2), 'f')    # ax, ay
+		self.bearing = zeros((0, 2), 'f')    # bl, bt
+		self.bitmapSize = zeros((0, 2), 'f') # bw, bh
+		self.position = zeros((0, 2), 'f')   # x, y in pixels
+		self.codepoints = zeros(0, int)
+		self.slotShelf = zeros(0, int)
+		self.freeSlots = []
+		
+		# Code points in the atlas (sorted) and their slots, rebuilt from
+		# codepoints when glyphs are added or evicted (see _findSlots)
+		self.lookupCodes = zeros(0, int)
+		self.lookupSlots = zeros(0, int)
+		self.lookupDirty = False
+		
+		# Counter used to find the least recently used shelf
+		self.clock = 0
+		
+		# Incremented whenever existing glyphs move or are evicted
+		self.generation = 0
+		
+		# Registry details (see getAtlas)
+		self.key = None
+		self.refcount = 0
+		
+		# Context the texture is made in
+		self.glContext = renderState.context
+		
+		# Cache files for this atlas (see save)
+		self.cachePath = None
+		
 		self.setup()
 		
 	def setup(self):
 		'''
-		Construct the texture atlas for the font
+		Construct the texture atlas for the font, with the ASCII
+		glyphs already in it
 		'''
-		face = Face(self.filename)
-		face.set_pixel_sizes(0, self.size)
-	
-		rowh, roww = 0,0
+		# Slot 0 is an empty glyph, used for glyphs that can't be placed
+		self._addSlot(-1, (self.size / 2, 0), (0, 0), (0, 0), (0, 0), -1)
 		
-		# Determine image size
-		for i in xrange(32,128):
-			face.load_char( chr(i), FT_LOAD_RENDER)
-			bitmap	= face.glyph.bitmap
-			
-			if roww + bitmap.width + 1 >= 1024: # max texture width
-				self.w  = max(self.w, roww)
-				self.h	+= rowh
-				roww = 0
-				rowh = 0
-			roww += bitmap.width + 1
-			rowh = max(rowh, bitmap.rows)
-			
-		self.w = max(self.w, roww)
-		self.h += rowh
-	
-	
-		## Create texture to hold ASCII glyphs
+		# Rasterize the ASCII glyphs before the texture exists, so the
+		# whole texture is uploaded at once (unless they are cached)
+		with tracer.span('atlas build', 'atlas'):
+			if not self._load():
+				for code in xrange(32, 128):
+					self._addGlyph(code)
+				self.save()
+		
+		## Create texture to hold the glyphs
 		
 		# Ensure no texture is currently selected
 		glActiveTexture(GL_TEXTURE0) 
 		self.texid = glGenTextures(1)
-		glBindTexture(GL_TEXTURE_2D, self.texid)
-		
-		glTexImage2D(GL_TEXTURE_2D, 0, GL_ALPHA, self.w, self.h, 0, GL_ALPHA, GL_UNSIGNED_BYTE, 0)
-		
-		# We require 1 byte alignment when uploading texture data
-		glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+		renderState.bindTexture(self.texid)
 		
 		# Clamping to edges is important to prevent artifacts when scaling
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
@@ -86,44 +218,344 @@ class Atlas(object):
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
 		
-	
-		# Add glyphs to texture
-		ox = 0
-		oy = 0
-		rowh = 0
+		self._uploadAll()
+		
+		
+	def _getCachePath(self):
+		'''
+		Returns the path (without extension) of the cache files, based on
+		the font file contents, pixel size and rasterization settings
+		'''
+		if self.cachePath is None:
+			digest = hashlib.sha1()
+			with open(self.filename, 'rb') as f:
+				digest.update(f.read())
+			digest.update('%d %d %d %d %d' % (_cacheVersion, self.size, self.loadFlags, self.w, self.padding))
+			self.cachePath = os.path.join(_cacheDirectory, digest.hexdigest())
+		return self.cachePath
+		
+	def _load(self):
+		'''
+		Load the atlas from the cache, returns False if it isn't cached
+		'''
+		if _cacheDirectory is None:
+			return False
+		
+		path = self._getCachePath()
+		try:
+			glyphs = numpy.load(path + '.glyphs.npy')
+			shelves = numpy.load(path + '.shelves.npy')
+			
+			# Copy on write, the pages are only read when uploading
+			bitmap = numpy.load(path + '.bitmap.npy', mmap_mode='c')
+		except (IOError, OSError, ValueError):
+			return False
+		
+		if glyphs.dtype != _glyphType or bitmap.shape[1] != self.w:
+			return False
+		
+		self.bitmap = bitmap
+		self.h = bitmap.shape[0]
+		self.shelfY = shelves[:,0].tolist()
+		self.shelfHeight = shelves[:,1].tolist()
+		self.shelfX = shelves[:,2].tolist()
+		for g in glyphs:
+			self._addSlot(int(g['codepoint']), g['advance'], g['bearing'], g['size'], g['position'], int(g['shelf']))
+		return True
+		
+	def save(self):
+		'''
+		Write the atlas, including any glyphs added since it was built,
+		to the cache directory (does nothing if there isn't one)
+		'''
+		if _cacheDirectory is None:
+			return
+		
+		live = (self.codepoints >= 0).nonzero()[0]
+		glyphs = zeros(len(live), _glyphType)
+		glyphs['codepoint'] = self.codepoints[live]
+		glyphs['advance'] = self.advance[live]
+		glyphs['bearing'] = self.bearing[live]
+		glyphs['size'] = self.bitmapSize[live]
+		glyphs['position'] = self.position[live]
+		glyphs['shelf'] = self.slotShelf[live]
+		
+		shelves = zeros((len(self.shelfY), 3), 'i4')
+		shelves[:,0] = self.shelfY
+		shelves[:,1] = self.shelfHeight
+		shelves[:,2] = self.shelfX
 		
-		# class to hold data
-		class CharInfo:
+		# The cache is only an optimisation, so failing to write it is fine
+		path = self._getCachePath()
+		try:
+			if not os.path.isdir(_cacheDirectory):
+				os.makedirs(_cacheDirectory)
+				
+			# Write to temporary files first, so readers never see partial files
+			for name, data in (('glyphs', glyphs), ('shelves', shelves), ('bitmap', self.bitmap)):
+				tmp = '%s.%s.%d.tmp' % (path, name, os.getpid())
+				with open(tmp, 'wb') as f:
+					numpy.save(f, data)
+				os.rename(tmp, '%s.%s.npy' % (path, name))
+		except (IOError, OSError):
 			pass
 		
-		for i in xrange(32,128):
-			face.load_char( chr(i), FT_LOAD_RENDER)
-			g = face.glyph
-			bitmap = g.bitmap
+		
+	def getGlyphs(self, codes):
+		'''
+		Returns the slots for an array of code points, rasterizing
+		any glyphs that aren't in the atlas yet
+		'''
+		codes = asarray(codes, int)
+		self.clock += 1
+		
+		if len(codes) == 0:
+			return zeros(0, int)
+		
+		# Mark the glyphs we already have as used first, so adding
+		# the missing ones can't evict them
+		slots = self._findSlots(codes)
+		missing = slots < 0
+		self.touch(slots[~missing], False)
+		
+		if missing.any():
+			with tracer.span('rasterize glyphs', 'atlas'):
+				for code in unique(codes[missing]):
+					self._addGlyph(code)
+			slots = self._findSlots(codes)
 			
-			if ox + bitmap.width + 1 >= 1024: # max texture width
-				oy += rowh
-				rowh = 0
-				ox = 0		
+			# Glyphs that didn't fit are drawn as the empty glyph
+			slots[slots < 0] = 0
 			
-			glTexSubImage2D(GL_TEXTURE_2D, 0, ox, oy, bitmap.width, bitmap.rows, GL_ALPHA, GL_UNSIGNED_BYTE, bitmap.buffer)
+		return slots
+		
+	def touch(self, slots, tick=True):
+		'''
+		Mark glyphs as used, so their shelves aren't evicted
+		'''
+		if tick:
+			self.clock += 1
+		shelves = self.slotShelf[slots]
+		self.shelfUsed[shelves[shelves >= 0]] = self.clock
+		
+	def getTexcoords(self, slots):
+		'''
+		Returns the texture coordinates (left, top, right, bottom)
+		of glyph slots
+		'''
+		position = self.position[slots]
+		size = self.bitmapSize[slots]
+		tex = zeros((len(slots), 4), 'f')
+		tex[:,0] = position[:,0] / self.w
+		tex[:,1] = position[:,1] / self.h
+		tex[:,2] = (position[:,0] + size[:,0]) / self.w
+		tex[:,3] = (position[:,1] + size[:,1]) / self.h
+		return tex
+		
+		
+	def _findSlots(self, codes):
+		'''
+		Returns the slots of an array of code points (-1 for those
+		not in the atlas)
+		'''
+		if self.lookupDirty:
+			live = (self.codepoints >= 0).nonzero()[0]
+			order = self.codepoints[live].argsort()
+			self.lookupCodes = self.codepoints[live][order]
+			self.lookupSlots = live[order]
+			self.lookupDirty = False
 			
-			ci = CharInfo()
-			ci.ax = float(g.advance.x >> 6)
-			ci.ay = float(g.advance.y >> 6)
+		if len(self.lookupCodes) == 0:
+			return zeros(len(codes), int) - 1
+		i = minimum(searchsorted(self.lookupCodes, codes), len(self.lookupCodes) - 1)
+		return where(self.lookupCodes[i] == codes, self.lookupSlots[i], -1)
+		
+	def _addSlot(self, code, advance, bearing, size, position, shelf):
+		'''
+		Store the metrics of a glyph, returns its slot
+		'''
+		if self.freeSlots == []:
+			# Double the capacity of the slot arrays
+			n = len(self.codepoints)
+			grow = max(n, 128)
+			self.advance = concatenate((self.advance, zeros((grow, 2), 'f')))
+			self.bearing = concatenate((self.bearing, zeros((grow, 2), 'f')))
+			self.bitmapSize = concatenate((self.bitmapSize, zeros((grow, 2), 'f')))
+			self.position = concatenate((self.position, zeros((grow, 2), 'f')))
+			self.codepoints = concatenate((self.codepoints, zeros(grow, int) - 1))
+			self.slotShelf = concatenate((self.slotShelf, zeros(grow, int) - 1))
+			self.freeSlots = list(range(n + grow - 1, n - 1, -1))
 			
-			ci.bw = float(bitmap.width)
-			ci.bh = float(bitmap.rows)
+		slot = self.freeSlots.pop()
+		self.advance[slot] = advance
+		self.bearing[slot] = bearing
+		self.bitmapSize[slot] = size
+		self.position[slot] = position
+		self.codepoints[slot] = code
+		self.slotShelf[slot] = shelf
+		
+		if code >= 0:
+			self.lookupDirty = True
+		return slot
+		
+	def _getFace(self):
+		if self.face is None:
+			self.face = Face(self.filename)
+			self.face.set_pixel_sizes(0, self.size)
+		return self.face
+		
+	def _addGlyph(self, code):
+		'''
+		Rasterize a glyph and add it to the atlas
+		'''
+		face = self._getFace()
+		try:
+			face.load_char(unichr(code), self.loadFlags)
+		except (ValueError, FT_Exception):
+			return
+		g = face.glyph
+		bitmap = g.bitmap
+		w, h = bitmap.width, bitmap.rows
+		
+		advance = (g.advance.x >> 6, g.advance.y >> 6)
+		bearing = (g.bitmap_left, g.bitmap_top)
+		
+		# Glyphs without pixels don't need space in the texture
+		if w == 0 or h == 0:
+			self._addSlot(code, advance, bearing, (0, 0), (0, 0), -1)
+			return
+		
+		shelf = self._allocate(w, h)
+		if shelf is None:
+			return
+		x, y = self.shelfX[shelf], self.shelfY[shelf]
+		self.shelfX[shelf] += w + self.padding
+		self.shelfUsed[shelf] = self.clock
+		
+		# Copy the pixels into the atlas (straight from FreeType's buffer)
+		self.bitmap[y:y + h, x:x + w] = bitmap.array
+		if self.texid:
+			self._upload(x, y, w, h)
 			
-			ci.bl = float(g.bitmap_left)
-			ci.bt = float(g.bitmap_top)
+		self._addSlot(code, advance, bearing, (w, h), (x, y), shelf)
+		
+		
+	def _allocate(self, w, h):
+		'''
+		Find a shelf with room for a w x h glyph, returns the shelf
+		index or None if the glyph can't be placed
+		'''
+		if w + self.padding > self.w:
+			return None
+		
+		# Use the existing shelf that wastes the least height
+		best = None
+		for i in xrange(len(self.shelfY)):
+			height = self.shelfHeight[i]
+			if height < h or self.shelfX[i] + w + self.padding > self.w:
+				continue
+			if best is None or height < self.shelfHeight[best]:
+				best = i
+		if best is not None and self.shelfHeight[best] <= h * 1.5:
+			return best
+		
+		# Otherwise start a new shelf
+		top = 0
+		if self.shelfY != []:
+			top = self.shelfY[-1] + self.shelfHeight[-1] + self.padding
+		while top + h > self.h and self.h < self.maxSize:
+			self._grow()
+		if top + h <= self.h:
+			self.shelfY.append(top)
+			self.shelfHeight.append(h)
+			self.shelfX.append(0)
+			return len(self.shelfY) - 1
+		
+		# A taller shelf with room is better than evicting
+		if best is not None:
+			return best
+		
+		return self._evict(h)
+		
+	def _grow(self):
+		'''
+		Double the height of the texture
+		'''
+		h = min(max(self.h * 2, 64), self.maxSize)
+		self.bitmap = concatenate((self.bitmap, zeros((h - self.h, self.w), 'B')))
+		self.h = h
+		
+		# Texture coordinates of existing glyphs change
+		self.generation += 1
+		if self.texid:
+			self._uploadAll()
 			
-			ci.tx = float(ox) / float(self.w)
-			ci.ty = float(oy) / float(self.h)
-			self.c[chr(i)] = ci
+	def _evict(self, h):
+		'''
+		Empty the least recently used shelf that is tall enough for a glyph
+		of height h, returns its index or None if all are in use
+		'''
+		best = None
+		for i in xrange(len(self.shelfY)):
+			# Shelves used by the current request can't be evicted
+			if self.shelfHeight[i] < h or self.shelfUsed[i] == self.clock:
+				continue
+			if best is None or self.shelfUsed[i] < self.shelfUsed[best]:
+				best = i
+		if best is None:
+			return None
+		
+		# Free the slots of the glyphs on the shelf
+		for slot in (self.slotShelf == best).nonzero()[0]:
+			self.codepoints[slot] = -1
+			self.slotShelf[slot] = -1
+			self.freeSlots.append(slot)
 			
-			rowh = max(rowh, bitmap.rows)
-			ox += bitmap.width + 1
+		# Clear the pixels
+		y, height = self.shelfY[best], self.shelfHeight[best]
+		self.bitmap[y:y + height] = 0
+		self._upload(0, y, self.w, height)
+		
+		self.shelfX[best] = 0
+		self.generation += 1
+		self.lookupDirty = True
+		return best
+		
+		
+	def _upload(self, x, y, w, h):
+		'''
+		Upload a region of the bitmap to the texture
+		'''
+		renderState.bindTexture(self.texid)
+		
+		# We require 1 byte alignment when uploading texture data
+		glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+		with tracer.span('texture upload', 'atlas'):
+			glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, w, h, GL_RED, GL_UNSIGNED_BYTE, 
+							self.bitmap[y:y + h, x:x + w].copy())
+		renderState.count('bytesUploaded', w * h)
+		
+	def _uploadAll(self):
+		'''
+		(Re)allocate the texture and upload the whole bitmap
+		'''
+		renderState.bindTexture(self.texid)
+		glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+		with tracer.span('texture upload', 'atlas'):
+			glTexImage2D(GL_TEXTURE_2D, 0, GL_R8, self.w, self.h, 0, GL_RED, GL_UNSIGNED_BYTE, self.bitmap)
+		renderState.count('bytesUploaded', self.bitmap.nbytes)
+		
+
+	def delete(self):
+		'''
+		Free the texture for this atlas
+		'''
+		if self.texid:
+			glDeleteTextures([self.texid])
+			renderState.invalidate()
+			self.texid = 0
 
 	def __del__(self):
-		glDeleteTextures([self.texid])
+		# Not outside its context (see BaseActor.__del__)
+		if renderState.owns(self.glContext):
+			self.delete()
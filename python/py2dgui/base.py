@@ -1,6 +1,5 @@
 import numpy
 import math
-import copy
 
 
 class Point(object):
@@ -126,9 +125,184 @@ class MatrixStack(object):
 
 				
 	def push(self):
-		matrix = copy.deepcopy(self.current)
-		self.stack.insert(0, matrix)
+		self.stack.insert(0, self.current.copy())
 		
 	def pop(self):
 		self.current = self.stack.pop(0)
 
+
+
+def transformMatrix(translation, rotation, scale):
+	'''
+	Build the matrix for a translation, rotation and scale
+	(applied in the same order as an actor applies them)
+	'''
+	matrix = MatrixStack()
+	matrix.translate(translation)
+	
+	# Skip the axes that aren't rotated
+	if rotation.x != 0:
+		matrix.rotatex(rotation.x)
+	if rotation.y != 0:
+		matrix.rotatey(rotation.y)
+	if rotation.z != 0:
+		matrix.rotatez(rotation.z)
+		
+	matrix.scale(scale)
+	return matrix.top()
+	
+	
+def transformMatrices(translations, rotations, scales):
+	'''
+	Build the matrices for arrays of translations, rotations
+	(in degrees) and scales, with one row per matrix
+	'''
+	n = len(translations)
+	radians = numpy.radians(rotations)
+	cos = numpy.cos(radians)
+	sin = numpy.sin(radians)
+	
+	# Rotation around each axis, as n 3x3 matrices
+	rx = numpy.zeros((n, 3, 3), 'f')
+	rx[:,0,0] = 1
+	rx[:,1,1] = cos[:,0]
+	rx[:,1,2] = -sin[:,0]
+	rx[:,2,1] = sin[:,0]
+	rx[:,2,2] = cos[:,0]
+	
+	ry = numpy.zeros((n, 3, 3), 'f')
+	ry[:,1,1] = 1
+	ry[:,0,0] = cos[:,1]
+	ry[:,0,2] = sin[:,1]
+	ry[:,2,0] = -sin[:,1]
+	ry[:,2,2] = cos[:,1]
+	
+	rz = numpy.zeros((n, 3, 3), 'f')
+	rz[:,2,2] = 1
+	rz[:,0,0] = cos[:,2]
+	rz[:,0,1] = -sin[:,2]
+	rz[:,1,0] = sin[:,2]
+	rz[:,1,1] = cos[:,2]
+	
+	rotation = numpy.einsum('nij,njk,nkl->nil', rx, ry, rz)
+	
+	# Translate * Rotate * Scale
+	matrices = numpy.zeros((n, 4, 4), 'f')
+	matrices[:,:3,:3] = rotation * numpy.asarray(scales, 'f')[:,numpy.newaxis,:]
+	matrices[:,:3,3] = translations
+	matrices[:,3,3] = 1
+	return matrices
+
+
+
+def projectionMatrix(w, h):
+	'''
+	Returns the orthographic projection from a w by h area
+	(with the origin at the bottom left) to clip space
+	'''
+	n = 0.5 # zNear
+	f = 3.0 # zFar
+	
+	return numpy.array([
+			[ 2/float(w),     0,           0,            -1        ],
+			[     0,      2/float(h),      0,            -1        ],
+			[     0,          0,      -2/(f-n),          -1        ],
+			[     0,          0,           0,             1        ]
+						],'f')
+	
+	
+def transformBounds(matrix, bounds):
+	'''
+	Returns the bounding box (xmin, ymin, xmax, ymax) of
+	a bounding box transformed by matrix
+	'''
+	if bounds is None:
+		return None
+	x0, y0, x1, y1 = bounds
+	corners = numpy.array([[x0, y0, 0, 1], [x1, y0, 0, 1], [x1, y1, 0, 1], [x0, y1, 0, 1]], 'f')
+	points = corners.dot(matrix.T)
+	low = points.min(0)
+	high = points.max(0)
+	return (low[0], low[1], high[0], high[1])
+	
+	
+def pointsBounds(points):
+	'''
+	Returns the bounding box (xmin, ymin, xmax, ymax) of an
+	array of points (one per row), or None if there are none
+	'''
+	if len(points) == 0:
+		return None
+	low = points[:,:2].min(0)
+	high = points[:,:2].max(0)
+	return (low[0], low[1], high[0], high[1])
+	
+	
+def unionBounds(a, b):
+	'''
+	Returns the bounding box containing both a and b
+	(either of which may be None)
+	'''
+	if a is None:
+		return b
+	if b is None:
+		return a
+	return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+	
+	
+def intersectsBounds(a, b):
+	'''
+	Returns True if the bounding boxes a and b overlap
+	'''
+	if a is None or b is None:
+		return False
+	return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+	
+	
+def pointInTriangles(triangles, x, y):
+	'''
+	Returns a boolean array saying which of the triangles (an array
+	of shape (n, 3, 2)) contain the point x, y (either winding)
+	'''
+	a = triangles[:,0]
+	b = triangles[:,1]
+	c = triangles[:,2]
+	d1 = (b[:,0] - a[:,0]) * (y - a[:,1]) - (b[:,1] - a[:,1]) * (x - a[:,0])
+	d2 = (c[:,0] - b[:,0]) * (y - b[:,1]) - (c[:,1] - b[:,1]) * (x - b[:,0])
+	d3 = (a[:,0] - c[:,0]) * (y - c[:,1]) - (a[:,1] - c[:,1]) * (x - c[:,0])
+	negative = (d1 < 0) | (d2 < 0) | (d3 < 0)
+	positive = (d1 > 0) | (d2 > 0) | (d3 > 0)
+	return ~(negative & positive)
+	
+	
+def trianglesIntersectBounds(triangles, bounds):
+	'''
+	Returns a boolean array saying which of the triangles (an array
+	of shape (n, 3, 2)) overlap the bounding box (xmin, ymin, xmax, ymax)
+	'''
+	# Separating axis test, first against the axes of the box
+	low = triangles.min(1)
+	high = triangles.max(1)
+	hit = (low[:,0] <= bounds[2]) & (high[:,0] >= bounds[0]) & \
+		  (low[:,1] <= bounds[3]) & (high[:,1] >= bounds[1])
+	
+	# Then against the normal of each triangle edge
+	corners = numpy.array([[bounds[0], bounds[1]], [bounds[2], bounds[1]],
+						   [bounds[2], bounds[3]], [bounds[0], bounds[3]]], 'f')
+	for i in xrange(3):
+		a = triangles[:,i]
+		edge = triangles[:,(i + 1) % 3] - a
+		normal = numpy.column_stack((-edge[:,1], edge[:,0]))
+		
+		# Which side of the edge the opposite vertex is on
+		side = ((triangles[:,(i + 2) % 3] - a) * normal).sum(1)
+		
+		# Distance of each box corner from the edge
+		distances = (corners[numpy.newaxis,:,:] - a[:,numpy.newaxis,:]) * normal[:,numpy.newaxis,:]
+		distances = distances.sum(2)
+		
+		# Separated if every corner is on the far side of the edge
+		outside = ((side[:,numpy.newaxis] > 0) & (distances < 0)) | \
+				  ((side[:,numpy.newaxis] < 0) & (distances > 0))
+		hit &= ~outside.all(1)
+	return hit
@@ -0,0 +1,122 @@
+from OpenGL.GL import   glGenVertexArrays,            \
+						GL_TRIANGLES
+
+from OpenGL.arrays import vbo
+from numpy import concatenate, empty
+
+from py2dgui.shaders import getShaderClass, renderState
+from py2dgui.trace import tracer
+
+
+
+class PrimitiveBatch(object):
+	'''
+	Collects PrimitiveActors that share the primitive shader and
+	draws them together with a single draw call.
+	Vertices are transformed into camera space on the CPU and packed
+	into one shared VBO, so the shader needs no per actor uniforms
+	'''
+	# Actortype (used to determine shader)
+	actortype = 'primitivebatch'
+
+	def __init__(self):
+
+		# Shared VBO and VAO (created on the first flush)
+		self.vbo = None
+		self.vao = None
+
+		# Entries queued since the last flush
+		self.entries = []
+
+		# Entries that are currently uploaded to the VBO
+		self.uploaded = []
+
+		# Number of vertices currently uploaded to the VBO
+		self.count = 0
+
+
+	def add(self, actor, matrix):
+		'''
+		Queue an actor to be drawn with the given model to camera matrix
+		'''
+		# World matrices are cached on the actor, so a new matrix object
+		# means the actor moved and its vertices need transforming again
+		if actor._batchMatrix is not matrix or actor._batchAlpha != actor.alpha or actor._batchDepth != actor.depth:
+			points, colors = actor.getVertexData()
+
+			# Interleave position, color and depth for each vertex
+			data = empty((len(points), 9), 'f')
+			data[:,:4] = points.dot(matrix.T)
+			data[:,4:8] = colors
+
+			# The primitive shader uses the actor alpha for every vertex
+			data[:,7] = actor.alpha
+			data[:,8] = actor.depth
+
+			actor._batchMatrix = matrix
+			actor._batchAlpha = actor.alpha
+			actor._batchDepth = actor.depth
+			actor._batchData = data
+
+		self.entries.append(actor._batchData)
+
+
+	def _upload(self):
+		'''
+		Pack the queued entries into the VBO, if they changed
+		'''
+		# Nothing to do if the same data is already uploaded
+		if len(self.entries) == len(self.uploaded):
+			for a, b in zip(self.entries, self.uploaded):
+				if a is not b:
+					break
+			else:
+				return
+
+		a = concatenate(self.entries)
+		self.count = len(a)
+
+		if self.vbo is None:
+			self.vbo = vbo.VBO(a, usage='GL_DYNAMIC_DRAW')
+
+			# The layout is interleaved, so the VAO never needs rebuilding
+			self.vao = glGenVertexArrays(1)
+			renderState.bindVertexArray(self.vao)
+			self.vbo.bind()
+			getShaderClass(self.actortype).setupAttributes(self)
+			renderState.bindVertexArray(0)
+			self.vbo.unbind()
+			renderState.count('bytesUploaded', a.nbytes)
+		else:
+			renderState.uploadBuffer(self.vbo, a)
+
+		self.uploaded = self.entries
+
+
+	def flush(self, stage):
+		'''
+		Draw all the queued actors
+		'''
+		if self.entries == []:
+			return
+
+		previous = renderState.actortype
+		renderState.setActorType(self.actortype)
+
+		with tracer.span('upload', self.actortype):
+			self._upload()
+		self.entries = []
+
+		# Get the correct shader from the stage
+		shader = stage.getShader(self.actortype)
+
+		renderState.bindVertexArray(self.vao)
+		with tracer.span('shader setup', self.actortype):
+			shader.setup(self)
+
+		# Render
+		with tracer.span('draw', self.actortype):
+			renderState.drawArrays(GL_TRIANGLES, 0, self.count)
+
+		shader.cleanup()
+		renderState.setActorType(previous)
@@ -0,0 +1,289 @@
+# Rendering without a window system, for servers and CI.
+#
+# PyOpenGL picks its platform when OpenGL is first imported, so set
+# PYOPENGL_PLATFORM to 'egl' (Mesa's surfaceless EGL) or 'osmesa'
+# before importing py2dgui, e.g.
+#
+#	PYOPENGL_PLATFORM=egl python render_thumbnails.py
+import os
+
+from OpenGL.GL import	glGenFramebuffers,          \
+						glBindFramebuffer,          \
+						glDeleteFramebuffers,       \
+						glGenRenderbuffers,         \
+						glBindRenderbuffer,         \
+						glDeleteRenderbuffers,      \
+						glRenderbufferStorage,      \
+						glFramebufferRenderbuffer,  \
+						glCheckFramebufferStatus,   \
+						glViewport,                 \
+						glClearColor,               \
+						glClear,                    \
+						glReadPixels,               \
+						glPixelStorei,              \
+						glFinish,                   \
+						GL_FRAMEBUFFER,             \
+						GL_FRAMEBUFFER_COMPLETE,    \
+						GL_RENDERBUFFER,            \
+						GL_COLOR_ATTACHMENT0,       \
+						GL_DEPTH_ATTACHMENT,        \
+						GL_RGBA8,                   \
+						GL_DEPTH_COMPONENT24,       \
+						GL_COLOR_BUFFER_BIT,        \
+						GL_DEPTH_BUFFER_BIT,        \
+						GL_PACK_ALIGNMENT,          \
+						GL_RGBA,                    \
+						GL_UNSIGNED_BYTE
+
+from numpy import frombuffer, uint8
+
+from py2dgui.stage import Stage
+from py2dgui.shaders import renderState
+
+
+
+class OffscreenContext(object):
+	'''
+	An OpenGL 3.3 core context with no window, created through EGL
+	(without a surface) or OSMesa, as chosen by PYOPENGL_PLATFORM
+	'''
+	def __init__(self):
+		self.platform = os.environ.get('PYOPENGL_PLATFORM')
+		if self.platform == 'egl':
+			self._createEGL()
+		elif self.platform == 'osmesa':
+			self._createOSMesa()
+		else:
+			raise Exception("Set PYOPENGL_PLATFORM to 'egl' or 'osmesa' before importing OpenGL for offscreen rendering")
+
+
+	def _createEGL(self):
+		from OpenGL import EGL
+
+		# Without a display server ask Mesa for its surfaceless platform
+		if 'DISPLAY' not in os.environ and 'WAYLAND_DISPLAY' not in os.environ:
+			os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+
+		self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+		major, minor = EGL.EGLint(), EGL.EGLint()
+		if not EGL.eglInitialize(self.display, major, minor):
+			raise Exception("Could not initialize EGL")
+
+		attributes = [
+			EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+			EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+			EGL.EGL_RED_SIZE, 8,
+			EGL.EGL_GREEN_SIZE, 8,
+			EGL.EGL_BLUE_SIZE, 8,
+			EGL.EGL_ALPHA_SIZE, 8,
+			EGL.EGL_NONE,
+		]
+		config = EGL.EGLConfig()
+		count = EGL.EGLint()
+		if not EGL.eglChooseConfig(self.display, (EGL.EGLint * len(attributes))(*attributes), config, 1, count) or count.value == 0:
+			raise Exception("No EGL config supports OpenGL")
+
+		EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+		attributes = [
+			EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+			EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+			EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+			EGL.EGL_NONE,
+		]
+		self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, (EGL.EGLint * len(attributes))(*attributes))
+		if self.context == EGL.EGL_NO_CONTEXT:
+			raise Exception("Could not create an OpenGL 3.3 EGL context")
+
+		# No surface, everything is drawn into the stage's framebuffer
+		self.makeCurrent()
+
+
+	def _createOSMesa(self):
+		from OpenGL import osmesa, arrays
+
+		attributes = [
+			osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+			osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+			osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+			osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+			0,
+		]
+		self.context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+		if not self.context:
+			raise Exception("Could not create an OpenGL 3.3 OSMesa context")
+
+		# OSMesa needs a buffer to be current, but nothing is drawn to it
+		self.buffer = arrays.GLubyteArray.zeros((1, 1, 4))
+		self.makeCurrent()
+
+
+	def makeCurrent(self):
+		'''
+		Make this the current context of the calling thread
+		'''
+		if self.platform == 'egl':
+			from OpenGL import EGL
+			if not EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, self.context):
+				raise Exception("Could not make the EGL context current")
+		else:
+			from OpenGL import osmesa
+			if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL_UNSIGNED_BYTE, 1, 1):
+				raise Exception("Could not make the OSMesa context current")
+		renderState.makeCurrent(self)
+
+
+	def delete(self):
+		'''
+		Destroy the context
+		'''
+		# Leave another current context alone
+		current = renderState.context is self
+		if self.platform == 'egl':
+			from OpenGL import EGL
+			if current:
+				EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+			# Not eglTerminate, the display is shared by every context
+			EGL.eglDestroyContext(self.display, self.context)
+		else:
+			from OpenGL import osmesa
+			osmesa.OSMesaDestroyContext(self.context)
+		self.context = None
+
+		# Nothing can be deleted from the context now
+		renderState.contextLost(self)
+
+
+# Context used by stages created without one
+_sharedContext = None
+
+
+def getSharedContext():
+	'''
+	Returns the context shared by the stages created without one,
+	creating it the first time (or again after it was deleted)
+	'''
+	global _sharedContext
+	if _sharedContext is None or _sharedContext.context is None:
+		_sharedContext = OffscreenContext()
+	return _sharedContext
+
+
+
+
+class OffscreenStage(Stage):
+	'''
+	Stage rendered into a framebuffer of a chosen size instead of a
+	window, with its frames returned as numpy arrays.
+
+	Stages share one context unless they are given their own. The
+	methods of a stage make its context current, but actors belong to
+	the context that is current when they are created, so call
+	makeCurrent before creating actors for a stage with its own context
+	'''
+	def __init__(self, width, height, context=None):
+		# The context has to exist before the stage makes any GL calls
+		if context is None:
+			context = getSharedContext()
+		self.context = context
+		self.context.makeCurrent()
+
+		# Framebuffer with color and depth renderbuffers
+		self.fbo = glGenFramebuffers(1)
+		self.colorBuffer, self.depthBuffer = glGenRenderbuffers(2)
+
+		# Color the framebuffer is cleared to before each frame
+		self.clearColor = (0, 0, 0, 1)
+
+		super(OffscreenStage, self).__init__(width, height)
+
+		# The framebuffer has a depth buffer
+		self.depthTesting = True
+
+
+	def makeCurrent(self):
+		'''
+		Make the stage's context current
+		'''
+		self.context.makeCurrent()
+
+
+	def resize(self, w, h):
+		'''
+		Set the size of the stage and reallocate the framebuffer
+		'''
+		self.makeCurrent()
+		glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+
+		glBindRenderbuffer(GL_RENDERBUFFER, self.colorBuffer)
+		glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, w, h)
+		glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.colorBuffer)
+
+		glBindRenderbuffer(GL_RENDERBUFFER, self.depthBuffer)
+		glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, w, h)
+		glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depthBuffer)
+		glBindRenderbuffer(GL_RENDERBUFFER, 0)
+
+		if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+			raise Exception("Could not create the offscreen framebuffer")
+
+		glViewport(0, 0, w, h)
+		super(OffscreenStage, self).resize(w, h)
+
+
+	def render(self):
+		'''
+		Clear the framebuffer and render the stage into it
+		'''
+		self.makeCurrent()
+		glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+		glViewport(0, 0, self.width, self.height)
+		glClearColor(*self.clearColor)
+		glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+		super(OffscreenStage, self).render()
+
+
+	def readFrame(self):
+		'''
+		Returns the last rendered frame as a (height, width, 4) uint8
+		RGBA array, top row first. Waits for the GPU to finish drawing it
+		'''
+		self.makeCurrent()
+		glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+		glPixelStorei(GL_PACK_ALIGNMENT, 1)
+		data = glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE)
+
+		# OpenGL rows start at the bottom
+		return frombuffer(data, uint8).reshape(self.height, self.width, 4)[::-1].copy()
+
+
+	def renderFrame(self):
+		'''
+		Render the stage and return the frame (see readFrame)
+		'''
+		self.render()
+		return self.readFrame()
+
+
+	def renderFrames(self, count):
+		'''
+		Render count frames without reading them back, and wait for the
+		GPU to finish them (for measuring throughput, see frameStats)
+		'''
+		for i in xrange(count):
+			self.render()
+		glFinish()
+
+
+	def pickPixel(self, x, y, wait=False):
+		self.makeCurrent()
+		return super(OffscreenStage, self).pickPixel(x, y, wait)
+
+
+	def delete(self):
+		'''
+		Delete the framebuffer (the context is left for other stages)
+		'''
+		self.makeCurrent()
+		glDeleteFramebuffers(1, [self.fbo])
+		glDeleteRenderbuffers(2, [self.colorBuffer, self.depthBuffer])
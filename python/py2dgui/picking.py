@@ -0,0 +1,317 @@
+from OpenGL.GL import   glGetUniformLocation,         \
+						glUniformMatrix4fv,           \
+						glUniform1ui,                 \
+						glGenFramebuffers,            \
+						glBindFramebuffer,            \
+						glDeleteFramebuffers,         \
+						glFramebufferTexture2D,       \
+						glCheckFramebufferStatus,     \
+						glGenTextures,                \
+						glDeleteTextures,             \
+						glTexImage2D,                 \
+						glTexParameteri,              \
+						glGenBuffers,                 \
+						glDeleteBuffers,              \
+						glBindBuffer,                 \
+						glBufferData,                 \
+						glMapBufferRange,             \
+						glUnmapBuffer,                \
+						glFenceSync,                  \
+						glClientWaitSync,             \
+						glDeleteSync,                 \
+						glClearBufferuiv,             \
+						glGetIntegerv,                \
+						glViewport,                   \
+						glDisable,                    \
+						glEnable,                     \
+						GL_FRAMEBUFFER,               \
+						GL_FRAMEBUFFER_BINDING,       \
+						GL_FRAMEBUFFER_COMPLETE,      \
+						GL_COLOR_ATTACHMENT0,         \
+						GL_COLOR,                     \
+						GL_TEXTURE_2D,                \
+						GL_TEXTURE_MIN_FILTER,        \
+						GL_TEXTURE_MAG_FILTER,        \
+						GL_NEAREST,                   \
+						GL_R32UI,                     \
+						GL_RED_INTEGER,               \
+						GL_UNSIGNED_INT,              \
+						GL_PIXEL_PACK_BUFFER,         \
+						GL_STREAM_READ,               \
+						GL_MAP_READ_BIT,              \
+						GL_SYNC_GPU_COMMANDS_COMPLETE,\
+						GL_SYNC_FLUSH_COMMANDS_BIT,   \
+						GL_ALREADY_SIGNALED,          \
+						GL_CONDITION_SATISFIED,       \
+						GL_VIEWPORT,                  \
+						GL_BLEND,                     \
+						GL_TRUE
+
+from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as glReadPixelsRaw
+
+from numpy import array, uint32
+
+import ctypes
+
+from py2dgui.shaders import BaseShader, PrimitiveShader, TextShader, ImageShader, InstancedShader, \
+							renderState
+
+
+
+# Vertex shader used by each actortype (the ID pass positions
+# everything exactly as the normal pass does)
+vertexSources = {
+	'primitive' : PrimitiveShader.primitiveVertex,
+	'text'      : TextShader.textVertex,
+	'image'     : ImageShader.imageVertex,
+	'instanced' : InstancedShader.instancedVertex,
+}
+
+
+
+class PickShader(BaseShader):
+	'''
+	A shader that writes an actor ID instead of a color,
+	using the vertex shader of the actor's normal shader
+	'''
+	# Fragment shader for the ID pass
+	pickFragment = """
+#version 330
+
+uniform uint objectId;
+out uint outputId;
+
+void main()
+{
+   outputId = objectId;
+}
+"""
+
+	# Constructor
+	def __init__(self, actortype):
+		if actortype not in vertexSources:
+			raise Exception("Can't pick actors of type '%s'" % actortype)
+		super(PickShader, self).__init__(vertexSources[actortype], PickShader.pickFragment)
+
+		self.name = actortype
+
+		# Get our shader entry points
+		self.uniform_modelCamera       = glGetUniformLocation(self.program, 'modelToCameraMatrix')
+		self.uniform_objectId          = glGetUniformLocation(self.program, 'objectId')
+
+
+	def setup(self, actor, objectId):
+		'''
+		Setup the shader uniforms.
+		Assumes actor.vao is already bound
+		'''
+		# Bind the shader
+		renderState.useProgram(self.program)
+
+		# Apply uniforms
+		glUniformMatrix4fv(self.uniform_modelCamera, 1, GL_TRUE, actor.modelCamera_matrix)
+		glUniform1ui(self.uniform_objectId, objectId)
+		renderState.count('uniformUploads', 2)
+
+
+	def cleanup(self):
+		'''
+		Cleans up after the shader has been used
+		'''
+		# The shader is left bound (see BaseShader.cleanup)
+		pass
+
+
+
+
+class PickBuffer(object):
+	'''
+	Offscreen integer framebuffer that the actors of a stage are drawn
+	into as IDs. The ID pass is only redrawn when the stage changed, and
+	pixels are read back through a pair of pixel buffer objects, so a
+	read never waits for the GPU unless asked to
+	'''
+	def __init__(self, stage):
+		self.stage = stage
+
+		# Size of the framebuffer
+		self.w = 0
+		self.h = 0
+
+		# Framebuffer with an R32UI texture attached
+		self.fbo = glGenFramebuffers(1)
+		self.texid = glGenTextures(1)
+
+		# ID shaders by actortype
+		self.shaders = {}
+
+		# Actors drawn in the last ID pass, ID n is actors[n - 1]
+		self.actors = []
+
+		# Stage revision the ID pass was drawn at (None to force a redraw)
+		self.revision = None
+
+		# Pixel buffers read into in turn, and the fence of the
+		# read pending in each (None if there isn't one)
+		self.pbos = glGenBuffers(2)
+		self.fences = [None, None]
+		self.next = 0
+		for pbo in self.pbos:
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+			glBufferData(GL_PIXEL_PACK_BUFFER, 4, None, GL_STREAM_READ)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+		# The most recent result that was read back
+		self.result = None
+
+
+	def _resize(self, w, h):
+		'''
+		Reallocate the texture for a new stage size
+		'''
+		self.w = w
+		self.h = h
+
+		renderState.bindTexture(self.texid)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_R32UI, w, h, 0, GL_RED_INTEGER, GL_UNSIGNED_INT, None)
+		renderState.bindTexture(0)
+
+		glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+		glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texid, 0)
+		if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+			raise Exception("Could not create the picking framebuffer")
+
+
+	def _getShader(self, actortype):
+		if actortype not in self.shaders:
+			self.shaders[actortype] = PickShader(actortype)
+		return self.shaders[actortype]
+
+
+	def update(self):
+		'''
+		Redraw the ID pass if the stage changed since it was last drawn.
+		Leaves the picking framebuffer bound
+		'''
+		stage = self.stage
+		previous = glGetIntegerv(GL_FRAMEBUFFER_BINDING)
+		viewport = glGetIntegerv(GL_VIEWPORT)
+
+		if (self.w, self.h) != (stage.width, stage.height):
+			self._resize(stage.width, stage.height)
+			self.revision = None
+
+		# Find the actors before checking the revision, finding
+		# them brings the stage up to date
+		visible = stage.getVisibleActors()
+		glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+		if self.revision == stage.revision:
+			return previous, viewport
+
+		actors = [actor for actor in visible if actor.actortype in vertexSources]
+		renderState.setActorType('picking')
+		glViewport(0, 0, self.w, self.h)
+		glDisable(GL_BLEND)
+		glClearBufferuiv(GL_COLOR, 0, array([0, 0, 0, 0], uint32))
+
+		# Draw the actors in order, so the topmost ID is left in each pixel
+		for i, actor in enumerate(actors):
+			actor._update()
+			actor._applyTransform()
+			shader = self._getShader(actor.actortype)
+			renderState.bindVertexArray(actor.vao)
+			shader.setup(actor, i + 1)
+			actor._drawArrays()
+			shader.cleanup()
+		renderState.reset()
+
+		glEnable(GL_BLEND)
+		self.actors = actors
+		self.revision = stage.revision
+		return previous, viewport
+
+
+	def request(self, x, y):
+		'''
+		Start reading the ID at pixel x, y
+		'''
+		previous, viewport = self.update()
+
+		# Reuse the older of the pixel buffers
+		i = self.next
+		self.next = 1 - i
+		if self.fences[i] is not None:
+			glDeleteSync(self.fences[i])
+			self.fences[i] = None
+
+		if 0 <= x < self.w and 0 <= y < self.h:
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[i])
+			glReadPixelsRaw(int(x), int(y), 1, 1, GL_RED_INTEGER, GL_UNSIGNED_INT, ctypes.c_void_p(0))
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+			self.fences[i] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+		glBindFramebuffer(GL_FRAMEBUFFER, previous)
+		glViewport(*viewport)
+
+
+	def _collect(self, i, wait):
+		'''
+		Read the result of pixel buffer i if it is ready (or if wait is True),
+		returns True if it was read
+		'''
+		fence = self.fences[i]
+		if fence is None:
+			return False
+
+		timeout = 1000000000 if wait else 0
+		status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+		if status not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+			return False
+		glDeleteSync(fence)
+		self.fences[i] = None
+
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[i])
+		pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, 4, GL_MAP_READ_BIT)
+		objectId = ctypes.cast(pointer, ctypes.POINTER(ctypes.c_uint32))[0]
+		glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+		if 0 < objectId <= len(self.actors):
+			self.result = self.actors[objectId - 1]
+		else:
+			self.result = None
+		return True
+
+
+	def pick(self, x, y, wait=False):
+		'''
+		Request the ID at pixel x, y and return the latest result that
+		has been read back. If wait is True, returns the result for x, y
+		'''
+		self.request(x, y)
+		newest = 1 - self.next
+
+		if wait:
+			self._collect(newest, True)
+		else:
+			# The older read first, so the newest result wins
+			self._collect(self.next, False)
+			self._collect(newest, False)
+		return self.result
+
+
+	def delete(self):
+		'''
+		Delete the OpenGL objects
+		'''
+		for fence in self.fences:
+			if fence is not None:
+				glDeleteSync(fence)
+		self.fences = [None, None]
+		glDeleteBuffers(2, self.pbos)
+		glDeleteTextures([self.texid])
+		renderState.invalidate()
+		glDeleteFramebuffers(1, [self.fbo])
+
@@ -2,9 +2,8 @@ from OpenGL.GL import   shaders,                      \
 						GL_VERTEX_SHADER,             \
 						GL_FRAGMENT_SHADER,           \
 						glVertexAttribPointer,	      \
+						glVertexAttribDivisor,        \
 						glEnableVertexAttribArray,    \
-						glDisableVertexAttribArray,   \
-						glGetAttribLocation,	      \
 						GL_FLOAT,				      \
 						glGetUniformLocation,         \
 						glUniformMatrix4fv,           \
@@ -14,9 +13,253 @@ from OpenGL.GL import   shaders,                      \
 						glUniform1f,                  \
 						GL_TRUE,                      \
 						glBindTexture,                \
+						glBindVertexArray,            \
+						glDrawArrays,                 \
+						glDrawArraysInstanced,        \
+						glGenBuffers,                 \
+						glBindBuffer,                 \
+						glBufferData,                 \
+						glBufferSubData,              \
+						glBindBufferBase,             \
+						glGetUniformBlockIndex,       \
+						glUniformBlockBinding,        \
+						GL_UNIFORM_BUFFER,            \
+						GL_DYNAMIC_DRAW,              \
 						GL_TEXTURE_2D
+
+from numpy import zeros
+
+import atexit
 						
 
+# Attribute locations (must match the layout qualifiers in the shaders)
+ATTRIB_POSITION = 0
+ATTRIB_COLOR = 1
+ATTRIB_INSTANCE_MATRIX = 2 # a mat4 uses locations 2 - 5
+ATTRIB_INSTANCE_COLOR = 6
+ATTRIB_DEPTH = 7
+
+# Binding point of the FrameUniforms block
+FRAME_UNIFORMS_BINDING = 0
+
+
+
+class FrameUniforms(object):
+	'''
+	Uniform buffer holding the values that are shared by every shader
+	program for a frame, so they are uploaded once rather than per actor
+	'''
+	def __init__(self):
+		# std140 layout: mat4 projectionMatrix (16 floats)
+		self.data = zeros(16, 'f')
+		
+		# Does the data need uploading
+		self.dirty = True
+		
+		# Create the buffer and attach it to the binding point
+		self.ubo = glGenBuffers(1)
+		glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+		glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+		glBindBufferBase(GL_UNIFORM_BUFFER, FRAME_UNIFORMS_BINDING, self.ubo)
+		glBindBuffer(GL_UNIFORM_BUFFER, 0)
+		
+	def setProjection(self, matrix):
+		'''
+		Set the projection matrix (row major)
+		'''
+		self.data[:16] = matrix.flatten()
+		self.dirty = True
+		
+	def upload(self):
+		'''
+		Attach the buffer to the binding point (another stage may have
+		taken it), and upload the values if they changed
+		'''
+		glBindBufferBase(GL_UNIFORM_BUFFER, FRAME_UNIFORMS_BINDING, self.ubo)
+		renderState.count('bufferBinds')
+		if not self.dirty:
+			return
+		
+		# Binding the base also bound the buffer to GL_UNIFORM_BUFFER
+		glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+		renderState.count('bytesUploaded', self.data.nbytes)
+		self.dirty = False
+
+
+
+
+# Names of the per frame render counters
+counterNames = ('drawCalls', 'programBinds', 'textureBinds', 'bufferBinds',
+				'vertices', 'uniformUploads', 'bytesUploaded')
+				
+				
+def sumCounters(frameCounters):
+	'''
+	Returns the counters of a frame (actortype -> counter name -> count)
+	summed over every actortype
+	'''
+	totals = dict.fromkeys(counterNames, 0)
+	for counters in frameCounters.itervalues():
+		for name, n in counters.iteritems():
+			totals[name] += n
+	return totals
+				
+				
+class RenderState(object):
+	'''
+	Remembers the program, texture and VAO that are bound, so binding
+	the one that is already bound can be skipped.
+	Also counts the GL work done each frame, by the actortype doing it
+	'''
+	def __init__(self):
+		# Currently bound objects (None if unknown)
+		self.program = None
+		self.texture = None
+		self.vao = None
+		
+		# Number of binds actually made
+		self.changes = 0
+		
+		# Count the work done each frame
+		self.counting = True
+		
+		# The actortype the work is counted against
+		self.actortype = 'stage'
+		
+		# actortype -> counter name -> count, for the frame in progress
+		# and the last complete frame
+		self.counters = {}
+		self.frameCounters = {}
+		
+		# The context GL calls go to (None for a window's own context)
+		self.context = None
+		
+		# False once the current context is gone, objects can't be
+		# deleted after that (see BaseActor.release)
+		self.alive = True
+		
+	def makeCurrent(self, context):
+		'''
+		Called when a context is made current, what was bound in
+		another context is forgotten
+		'''
+		if context is not self.context:
+			self.context = context
+			self.invalidate()
+		self.alive = True
+		
+	def contextLost(self, context=None):
+		'''
+		Called when a context is destroyed, or with no context when
+		the interpreter exits
+		'''
+		if context is None or context is self.context:
+			self.alive = False
+			self.invalidate()
+		
+		# The atlas textures went with the context
+		if context is not None:
+			from py2dgui.atlas import forgetAtlases
+			forgetAtlases(context)
+		
+	def owns(self, context):
+		'''
+		Returns True if the objects made in context can be deleted now
+		(the context is current and hasn't been destroyed)
+		'''
+		return self.alive and context is self.context
+		
+	def count(self, name, n=1):
+		'''
+		Add n to a counter of the current actortype
+		'''
+		if not self.counting:
+			return
+		counters = self.counters.get(self.actortype)
+		if counters is None:
+			counters = self.counters[self.actortype] = dict.fromkeys(counterNames, 0)
+		counters[name] += n
+		
+	def setActorType(self, actortype):
+		'''
+		Count the following work against actortype
+		'''
+		self.actortype = actortype
+		
+	def endFrame(self):
+		'''
+		Finish counting a frame, returns its counters
+		'''
+		self.frameCounters = self.counters
+		self.counters = {}
+		self.actortype = 'stage'
+		return self.frameCounters
+		
+	def useProgram(self, program):
+		if program != self.program:
+			shaders.glUseProgram(program)
+			self.program = program
+			self.changes += 1
+			self.count('programBinds')
+			
+	def bindTexture(self, texid):
+		if texid != self.texture:
+			glBindTexture(GL_TEXTURE_2D, texid)
+			self.texture = texid
+			self.changes += 1
+			self.count('textureBinds')
+			
+	def bindVertexArray(self, vao):
+		if vao != self.vao:
+			glBindVertexArray(vao)
+			self.vao = vao
+			self.changes += 1
+			self.count('bufferBinds')
+			
+	def uploadBuffer(self, buffer, data):
+		'''
+		Replace the contents of a VBO (the data is uploaded when it is bound)
+		'''
+		buffer.set_array(data)
+		buffer.bind()
+		buffer.unbind()
+		self.count('bufferBinds')
+		self.count('bytesUploaded', data.nbytes)
+		
+	def drawArrays(self, mode, first, count):
+		glDrawArrays(mode, first, count)
+		self.count('drawCalls')
+		self.count('vertices', count)
+		
+	def drawArraysInstanced(self, mode, first, count, instances):
+		glDrawArraysInstanced(mode, first, count, instances)
+		self.count('drawCalls')
+		self.count('vertices', count * instances)
+		
+	def invalidate(self):
+		'''
+		Forget what is bound (after objects are deleted, or bound directly)
+		'''
+		self.program = None
+		self.texture = None
+		self.vao = None
+		
+	def reset(self):
+		'''
+		Unbind everything
+		'''
+		self.useProgram(0)
+		self.bindTexture(0)
+		self.bindVertexArray(0)
+		
+		
+# The state of the current OpenGL context
+renderState = RenderState()
+
+# Finalizers that run during shutdown mustn't call into OpenGL
+atexit.register(renderState.contextLost)
+
+
 
 
 class BaseShader(object):
@@ -35,6 +278,18 @@ class BaseShader(object):
 		# Join them as the shader program
 		self.program = shaders.compileProgram(VERTEX_SHADER, FRAGMENT_SHADER)
 		
+		# Use the shared FrameUniforms buffer
+		index = glGetUniformBlockIndex(self.program, 'FrameUniforms')
+		glUniformBlockBinding(self.program, index, FRAME_UNIFORMS_BINDING)
+		
+	@staticmethod
+	def setupAttributes(actor):
+		'''
+		Set the attribute pointers of an actor's VAO.
+		Assumes the VAO and actor.vbo are already bound
+		'''
+		raise NotImplementedError
+		
 	def setup(self, actor):
 		'''
 		Calls that should happen before any drawing
@@ -65,7 +320,13 @@ layout (location = 1) in vec4 color;
 smooth out vec4 theColor;
 
 uniform mat4 modelToCameraMatrix;
-uniform mat4 projectionMatrix;
+// Depth of the actor in the draw order (see Stage.render)
+uniform float depth;
+// Values shared by all shaders for the frame (see FrameUniforms)
+layout (std140, row_major) uniform FrameUniforms
+{
+	mat4 projectionMatrix;
+};
 
 
 
@@ -76,6 +337,7 @@ void main()
 	
 	// Then apply the projection Matrix
 	gl_Position = projectionMatrix * cameraPosition;
+	gl_Position.z = depth;
 	
 	// Pass on the color value
 	theColor = color;
@@ -91,7 +353,7 @@ out vec4 outputColor;
 
 void main()
 {
-   outputColor = (theColor.xyz, alpha);
+   outputColor = vec4(theColor.xyz, alpha);
 }
 """
 
@@ -100,48 +362,51 @@ void main()
 		super(PrimitiveShader, self).__init__(PrimitiveShader.primitiveVertex, PrimitiveShader.primitiveFragment)
 		
 		# Get our shader entry points
-		self.attrib_position           = glGetAttribLocation(self.program, 'position')
-		self.attrib_color              = glGetAttribLocation(self.program, 'color')
 		self.uniform_modelCamera       = glGetUniformLocation(self.program, 'modelToCameraMatrix')
-		self.uniform_projection        = glGetUniformLocation(self.program, 'projectionMatrix')
 		self.uniform_alpha             = glGetUniformLocation(self.program, 'alpha')
+		self.uniform_depth             = glGetUniformLocation(self.program, 'depth')
 		
 		
-		
-	def setup(self, actor):
+	@staticmethod
+	def setupAttributes(actor):
 		'''
-		Setup the shader uniforms / attributes.
-		Assumes actor.vbo is already bound
+		Set the attribute pointers of an actor's VAO.
+		Assumes the VAO and actor.vbo are already bound
 		'''
-		# Bind the shader
-		shaders.glUseProgram(self.program)
-
 		# Enable vertex attribute arrays
-		glEnableVertexAttribArray(self.attrib_position)
-		glEnableVertexAttribArray(self.attrib_color)
+		glEnableVertexAttribArray(ATTRIB_POSITION)
+		glEnableVertexAttribArray(ATTRIB_COLOR)
 			
 		# colorOffset is sizeof float (4) * floats per point (4) * num of points (vbo/2)
 		colorOffset = 4 * 4 * (len(actor.vbo) / 2) 
 
 		# Set the Attribute pointers			
-		glVertexAttribPointer(self.attrib_position, 4, GL_FLOAT, False, 0, actor.vbo)
-		glVertexAttribPointer(self.attrib_color,    4, GL_FLOAT, False, 0, actor.vbo + colorOffset)
+		glVertexAttribPointer(ATTRIB_POSITION, 4, GL_FLOAT, False, 0, actor.vbo)
+		glVertexAttribPointer(ATTRIB_COLOR,    4, GL_FLOAT, False, 0, actor.vbo + colorOffset)
+		
+		
+	def setup(self, actor):
+		'''
+		Setup the shader uniforms.
+		Assumes actor.vao is already bound
+		'''
+		# Bind the shader
+		renderState.useProgram(self.program)
 
 		# Apply uniforms
 		glUniformMatrix4fv(self.uniform_modelCamera, 1, GL_TRUE, actor.modelCamera_matrix)
-		glUniformMatrix4fv(self.uniform_projection, 1, GL_TRUE, actor.projection_matrix)
 		glUniform1f(self.uniform_alpha, actor.alpha)
+		glUniform1f(self.uniform_depth, actor.depth)
+		renderState.count('uniformUploads', 3)
 		
 		
 	def cleanup(self):
 		'''
 		Cleans up after the shader has been used
 		'''
-		glDisableVertexAttribArray(self.attrib_position)
-		glDisableVertexAttribArray(self.attrib_color)
-		
-		# Unbind the shader
-		shaders.glUseProgram(0)
+		# The shader is left bound, so the next actor using it
+		# doesn't bind it again (the stage unbinds it after the frame)
+		pass
 
 
 
@@ -163,7 +428,13 @@ layout (location = 0) in vec4 position;
 
 out vec2 texpos;
 uniform mat4 modelToCameraMatrix;
-uniform mat4 projectionMatrix;
+// Depth of the actor in the draw order (see Stage.render)
+uniform float depth;
+// Values shared by all shaders for the frame (see FrameUniforms)
+layout (std140, row_major) uniform FrameUniforms
+{
+	mat4 projectionMatrix;
+};
  
 void main()
 {
@@ -175,6 +446,7 @@ void main()
   
   // Then apply the projection Matrix 
   gl_Position = projectionMatrix * p2;
+  gl_Position.z = depth;
   
   texpos = position.zw;
 }
@@ -192,7 +464,8 @@ out vec4 outputColor;
  
 void main() 
 {
-  outputColor = vec4(1, 1, 1, texture2D(tex, texpos).a) * vec4(color.xyz, alpha);
+  // The coverage is in the red channel (GL_ALPHA textures aren't in the core profile)
+  outputColor = vec4(1, 1, 1, texture2D(tex, texpos).r) * vec4(color.xyz, alpha);
 }
 """
 	# Constructor
@@ -200,38 +473,45 @@ void main()
 		super(TextShader, self).__init__(TextShader.textVertex, TextShader.textFragment)
 		
 		# Get our shader entry points
-		self.attrib_position         = glGetAttribLocation(self.program, 'position')
 		self.uniform_modelCamera     = glGetUniformLocation(self.program, 'modelToCameraMatrix')
-		self.uniform_projection      = glGetUniformLocation(self.program, 'projectionMatrix')
 		self.uniform_color           = glGetUniformLocation(self.program, 'color')
 		self.uniform_tex             = glGetUniformLocation(self.program, 'tex')
 		self.uniform_alpha           = glGetUniformLocation(self.program, 'alpha')
+		self.uniform_depth           = glGetUniformLocation(self.program, 'depth')
 
 
-	def setup(self, actor):
+	@staticmethod
+	def setupAttributes(actor):
 		'''
-		Setup the shader uniforms / attributes.
-		Assumes actor.vbo is already bound
+		Set the attribute pointers of an actor's VAO.
+		Assumes the VAO and actor.vbo are already bound
 		'''
-		# Bind the shader
-		shaders.glUseProgram(self.program)
-		
 		# Enable vertex attribute array
-		glEnableVertexAttribArray(self.attrib_position)
+		glEnableVertexAttribArray(ATTRIB_POSITION)
 		
 		# Set the Attribute pointer
-		glVertexAttribPointer(self.attrib_position, 4, GL_FLOAT, False, 0, actor.vbo)
+		glVertexAttribPointer(ATTRIB_POSITION, 4, GL_FLOAT, False, 0, actor.vbo)
+		
+
+	def setup(self, actor):
+		'''
+		Setup the shader uniforms.
+		Assumes actor.vao is already bound
+		'''
+		# Bind the shader
+		renderState.useProgram(self.program)
 		
 		# Apply Uniforms
 		glUniformMatrix4fv(self.uniform_modelCamera, 1, GL_TRUE, actor.modelCamera_matrix)
-		glUniformMatrix4fv(self.uniform_projection, 1, GL_TRUE, actor.projection_matrix)
 		glUniform4fv(self.uniform_color, 1, actor.color.data)
 		glUniform1f(self.uniform_alpha, actor.alpha)
+		glUniform1f(self.uniform_depth, actor.depth)
 		glUniform1i(self.uniform_tex, 0)
+		renderState.count('uniformUploads', 5)
 		
 		
 		# Bind to the correct texture
-		glBindTexture(GL_TEXTURE_2D, actor.atlas.texid)
+		renderState.bindTexture(actor.atlas.texid)
 		
 		
 		
@@ -240,10 +520,9 @@ void main()
 		'''
 		Cleans up after the shader has been used
 		'''
-		glDisableVertexAttribArray(self.attrib_position)
-		
-		# Unbind the shader
-		shaders.glUseProgram(0)
+		# The shader is left bound, so the next actor using it
+		# doesn't bind it again (the stage unbinds it after the frame)
+		pass
 		
 		
 		
@@ -260,7 +539,13 @@ class ImageShader(BaseShader):
 
 layout (location = 0) in vec4 position;
 uniform mat4 modelToCameraMatrix;
-uniform mat4 projectionMatrix;
+// Depth of the actor in the draw order (see Stage.render)
+uniform float depth;
+// Values shared by all shaders for the frame (see FrameUniforms)
+layout (std140, row_major) uniform FrameUniforms
+{
+	mat4 projectionMatrix;
+};
 
 out vec2 texpos;
 
@@ -275,6 +560,7 @@ void main()
 	
 	// Then apply the projection Matrix
 	gl_Position = projectionMatrix * cameraPosition;
+	gl_Position.z = depth;
 	
 	texpos = position.zw; 
 	
@@ -304,44 +590,358 @@ void main()
 		super(ImageShader, self).__init__(ImageShader.imageVertex, ImageShader.imageFragment)
 		
 		# Get our shader entry points
-		self.attrib_position           = glGetAttribLocation(self.program, 'position')
 		self.uniform_modelCamera       = glGetUniformLocation(self.program, 'modelToCameraMatrix')
-		self.uniform_projection        = glGetUniformLocation(self.program, 'projectionMatrix')
 		self.uniform_alpha             = glGetUniformLocation(self.program, 'alpha')
+		self.uniform_depth             = glGetUniformLocation(self.program, 'depth')
+		
+		
+	@staticmethod
+	def setupAttributes(actor):
+		'''
+		Set the attribute pointers of an actor's VAO.
+		Assumes the VAO and actor.vbo are already bound
+		'''
+		# Enable vertex attribute arrays
+		glEnableVertexAttribArray(ATTRIB_POSITION)
+			
+		# Set the Attribute pointers			
+		glVertexAttribPointer(ATTRIB_POSITION, 4, GL_FLOAT, False, 0, actor.vbo)
 		
 		
 	def setup(self, actor):
 		'''
-		Setup the shader uniforms / attributes.
-		Assumes actor.vbo is already bound
+		Setup the shader uniforms.
+		Assumes actor.vao is already bound
 		'''
 		# Bind the shader
-		shaders.glUseProgram(self.program)
+		renderState.useProgram(self.program)
+
+		# Apply uniforms
+		glUniformMatrix4fv(self.uniform_modelCamera, 1, GL_TRUE, actor.modelCamera_matrix)
+		glUniform1f(self.uniform_alpha, actor.alpha)
+		glUniform1f(self.uniform_depth, actor.depth)
+		renderState.count('uniformUploads', 3)
+		
+		# Bind to the correct texture
+		renderState.bindTexture(actor.texid)
+		
+		
+	def cleanup(self):
+		'''
+		Cleans up after the shader has been used
+		'''
+		# The shader is left bound, so the next actor using it
+		# doesn't bind it again (the stage unbinds it after the frame)
+		pass
+
+		
+		
+class PrimitiveBatchShader(BaseShader):
+	'''
+	A shader for the PrimitiveBatch
+	'''
+	# Shader name (should match actorname attribute of actor instance)
+	name = 'primitivebatch'
+	
+	# Vertex shader for the batch, positions are already in camera space
+	batchVertex = """
+#version 330
 
+layout (location = 0) in vec4 position;
+layout (location = 1) in vec4 color;
+layout (location = 7) in float depth;
+
+smooth out vec4 theColor;
+
+// Values shared by all shaders for the frame (see FrameUniforms)
+layout (std140, row_major) uniform FrameUniforms
+{
+	mat4 projectionMatrix;
+};
+
+
+
+void main()
+{
+	// Apply the projection Matrix
+	gl_Position = projectionMatrix * position;
+	gl_Position.z = depth;
+	
+	// Pass on the color value (alpha is stored per vertex)
+	theColor = color;
+}
+"""
+	# Fragment shader for the batch
+	batchFragment = """
+#version 330
+
+smooth in vec4 theColor;
+out vec4 outputColor;
+
+void main()
+{
+   outputColor = theColor;
+}
+"""
+
+	# Constructor
+	def __init__(self):
+		super(PrimitiveBatchShader, self).__init__(PrimitiveBatchShader.batchVertex, PrimitiveBatchShader.batchFragment)
+		
+		
+	@staticmethod
+	def setupAttributes(batch):
+		'''
+		Set the attribute pointers of the batch VAO.
+		Assumes the VAO and batch.vbo are already bound
+		'''
 		# Enable vertex attribute arrays
-		glEnableVertexAttribArray(self.attrib_position)
+		glEnableVertexAttribArray(ATTRIB_POSITION)
+		glEnableVertexAttribArray(ATTRIB_COLOR)
+		glEnableVertexAttribArray(ATTRIB_DEPTH)
 			
+		# Position, color and depth are interleaved, stride is sizeof float (4) * floats per vertex (9)
+		stride = 4 * 9
+
 		# Set the Attribute pointers			
-		glVertexAttribPointer(self.attrib_position, 4, GL_FLOAT, False, 0, actor.vbo)
+		glVertexAttribPointer(ATTRIB_POSITION, 4, GL_FLOAT, False, stride, batch.vbo)
+		glVertexAttribPointer(ATTRIB_COLOR,    4, GL_FLOAT, False, stride, batch.vbo + 4 * 4)
+		glVertexAttribPointer(ATTRIB_DEPTH,    1, GL_FLOAT, False, stride, batch.vbo + 4 * 8)
+		
+		
+	def setup(self, batch):
+		'''
+		Setup the shader uniforms.
+		Assumes batch.vao is already bound
+		'''
+		# Bind the shader
+		renderState.useProgram(self.program)
+		
+		
+	def cleanup(self):
+		'''
+		Cleans up after the shader has been used
+		'''
+		# The shader is left bound, so the next actor using it
+		# doesn't bind it again (the stage unbinds it after the frame)
+		pass
+
+		
+		
+class InstancedShader(BaseShader):
+	'''
+	A shader for InstancedActors
+	'''
+	# Shader name (should match actorname attribute of actor instance)
+	name = 'instanced'
+	
+	# Vertex shader for InstancedActors
+	instancedVertex = """
+#version 330
+
+layout (location = 0) in vec4 position;
+layout (location = 2) in mat4 instanceMatrix;
+layout (location = 6) in vec4 instanceColor;
+
+smooth out vec4 theColor;
+
+uniform mat4 modelToCameraMatrix;
+// Depth of the actor in the draw order (see Stage.render)
+uniform float depth;
+// Values shared by all shaders for the frame (see FrameUniforms)
+layout (std140, row_major) uniform FrameUniforms
+{
+	mat4 projectionMatrix;
+};
+
+
+
+void main()
+{
+	// Apply the instance matrix, then the model to camera matrix
+	vec4 cameraPosition = modelToCameraMatrix * (instanceMatrix * position);
+	
+	// Then apply the projection Matrix
+	gl_Position = projectionMatrix * cameraPosition;
+	gl_Position.z = depth;
+	
+	// Pass on the color value of the instance
+	theColor = instanceColor;
+}
+"""
+	# Fragment shader for InstancedActors
+	instancedFragment = """
+#version 330
+
+smooth in vec4 theColor;
+uniform float alpha;
+out vec4 outputColor;
+
+void main()
+{
+   outputColor = vec4(theColor.xyz, theColor.w * alpha);
+}
+"""
+
+	# Constructor
+	def __init__(self):
+		super(InstancedShader, self).__init__(InstancedShader.instancedVertex, InstancedShader.instancedFragment)
+		
+		# Get our shader entry points
+		self.uniform_modelCamera       = glGetUniformLocation(self.program, 'modelToCameraMatrix')
+		self.uniform_alpha             = glGetUniformLocation(self.program, 'alpha')
+		self.uniform_depth             = glGetUniformLocation(self.program, 'depth')
+		
+		
+	@staticmethod
+	def setupAttributes(actor):
+		'''
+		Set the attribute pointers of an actor's VAO.
+		Assumes the VAO and actor.vbo (the shared geometry) are already bound
+		'''
+		# Geometry, the positions are at the start of the template VBO
+		glEnableVertexAttribArray(ATTRIB_POSITION)
+		glVertexAttribPointer(ATTRIB_POSITION, 4, GL_FLOAT, False, 0, actor.vbo)
+		
+		# Per instance values, stride is sizeof float (4) * floats per instance (20)
+		actor.instanceVBO.bind()
+		stride = 4 * 20
+		
+		# The matrix takes one location per column
+		for i in xrange(4):
+			glEnableVertexAttribArray(ATTRIB_INSTANCE_MATRIX + i)
+			glVertexAttribPointer(ATTRIB_INSTANCE_MATRIX + i, 4, GL_FLOAT, False, stride, actor.instanceVBO + 4 * 4 * i)
+			glVertexAttribDivisor(ATTRIB_INSTANCE_MATRIX + i, 1)
+			
+		glEnableVertexAttribArray(ATTRIB_INSTANCE_COLOR)
+		glVertexAttribPointer(ATTRIB_INSTANCE_COLOR, 4, GL_FLOAT, False, stride, actor.instanceVBO + 4 * 16)
+		glVertexAttribDivisor(ATTRIB_INSTANCE_COLOR, 1)
+		
+		actor.instanceVBO.unbind()
+		
+		
+	def setup(self, actor):
+		'''
+		Setup the shader uniforms.
+		Assumes actor.vao is already bound
+		'''
+		# Bind the shader
+		renderState.useProgram(self.program)
 
 		# Apply uniforms
 		glUniformMatrix4fv(self.uniform_modelCamera, 1, GL_TRUE, actor.modelCamera_matrix)
-		glUniformMatrix4fv(self.uniform_projection, 1, GL_TRUE, actor.projection_matrix)
 		glUniform1f(self.uniform_alpha, actor.alpha)
-		
-		# Bind to the correct texture
-		glBindTexture(GL_TEXTURE_2D, actor.texid)
+		glUniform1f(self.uniform_depth, actor.depth)
+		renderState.count('uniformUploads', 3)
 		
 		
 	def cleanup(self):
 		'''
 		Cleans up after the shader has been used
 		'''
-		glDisableVertexAttribArray(self.attrib_position)
+		# The shader is left bound, so the next actor using it
+		# doesn't bind it again (the stage unbinds it after the frame)
+		pass
+
+		
 		
-		# Unbind the shader
-		shaders.glUseProgram(0)
+class GroupCacheShader(ImageShader):
+	'''
+	A shader for Groups drawn from their cached texture
+	'''
+	# Shader name
+	name = 'groupcache'
+	
+	# Fragment shader for the cached texture, which holds premultiplied colors
+	cacheFragment = """
+#version 330
+
+uniform sampler2D tex;
+in vec2 texpos;
+
+uniform float alpha;
+
+out vec4 outputColor;
+
+void main()
+{
+	outputColor = texture2D(tex, texpos) * alpha;
+}
+"""
 
+	# Constructor
+	def __init__(self):
+		BaseShader.__init__(self, ImageShader.imageVertex, GroupCacheShader.cacheFragment)
+		
+		# Get our shader entry points
+		self.uniform_modelCamera       = glGetUniformLocation(self.program, 'modelToCameraMatrix')
+		self.uniform_alpha             = glGetUniformLocation(self.program, 'alpha')
+		self.uniform_depth             = glGetUniformLocation(self.program, 'depth')
 		
 		
-shaderlist = [PrimitiveShader, TextShader, ImageShader]
\ No newline at end of file
+		
+class FrozenGroupShader(PrimitiveShader):
+	'''
+	A shader for the baked geometry of frozen Groups
+	'''
+	# Shader name
+	name = 'frozengroup'
+	
+	# Fragment shader for the baked geometry, the alpha of each
+	# actor is stored per vertex
+	frozenFragment = """
+#version 330
+
+smooth in vec4 theColor;
+uniform float alpha;
+out vec4 outputColor;
+
+void main()
+{
+   outputColor = vec4(theColor.xyz, theColor.w * alpha);
+}
+"""
+
+	# Constructor
+	def __init__(self):
+		BaseShader.__init__(self, PrimitiveShader.primitiveVertex, FrozenGroupShader.frozenFragment)
+		
+		# Get our shader entry points
+		self.uniform_modelCamera       = glGetUniformLocation(self.program, 'modelToCameraMatrix')
+		self.uniform_alpha             = glGetUniformLocation(self.program, 'alpha')
+		self.uniform_depth             = glGetUniformLocation(self.program, 'depth')
+		
+		
+	@staticmethod
+	def setupAttributes(group):
+		'''
+		Set the attribute pointers of a group's frozen VAO.
+		Assumes the VAO and group.frozenVBO are already bound
+		'''
+		# Enable vertex attribute arrays
+		glEnableVertexAttribArray(ATTRIB_POSITION)
+		glEnableVertexAttribArray(ATTRIB_COLOR)
+			
+		# Position and color are interleaved, stride is sizeof float (4) * floats per vertex (8)
+		stride = 4 * 8
+
+		# Set the Attribute pointers			
+		glVertexAttribPointer(ATTRIB_POSITION, 4, GL_FLOAT, False, stride, group.frozenVBO)
+		glVertexAttribPointer(ATTRIB_COLOR,    4, GL_FLOAT, False, stride, group.frozenVBO + 4 * 4)
+		
+		
+		
+shaderlist = [PrimitiveShader, TextShader, ImageShader, PrimitiveBatchShader, InstancedShader, GroupCacheShader,
+			  FrozenGroupShader]
+
+
+def getShaderClass(shadername):
+	'''
+	Returns the shader class that matches shadername
+	'''
+	for shader in shaderlist:
+		if shader.name == shadername:
+			return shader
+	
+	# Shader could not be found, raise exception	
+	raise Exception("Could not find shader that matched '%s'" % shadername)
\ No newline at end of file
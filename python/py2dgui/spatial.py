@@ -0,0 +1,147 @@
+from math import floor
+
+from py2dgui.base import intersectsBounds
+
+
+
+class SpatialGrid(object):
+	'''
+	Uniform grid of bounding boxes (xmin, ymin, xmax, ymax), used to
+	find the items in a region without looking at every item.
+	Items are stored in every cell their bounds overlap, items that
+	would cover too many cells are kept in a separate list instead
+	'''
+	def __init__(self, cellSize=256, maxCells=64):
+		self.cellSize = float(cellSize)
+
+		# Items covering more cells than this go in the large list
+		self.maxCells = maxCells
+
+		# (column, row) -> set of items
+		self.cells = {}
+
+		# Items too large for the cells
+		self.large = set()
+
+		# item -> (bounds, cell range or None for large items)
+		self.items = {}
+
+
+	def __len__(self):
+		return len(self.items)
+
+	def __contains__(self, item):
+		return item in self.items
+
+	def getBounds(self, item):
+		'''
+		Returns the bounds an item was stored with (None if it isn't stored)
+		'''
+		entry = self.items.get(item)
+		if entry is None:
+			return None
+		return entry[0]
+
+
+	def _cellRange(self, bounds):
+		'''
+		Returns the (column, row) range of cells covered by bounds
+		'''
+		s = self.cellSize
+		return (int(floor(bounds[0] / s)), int(floor(bounds[1] / s)),
+				int(floor(bounds[2] / s)), int(floor(bounds[3] / s)))
+
+
+	def insert(self, item, bounds):
+		'''
+		Add an item with the given bounds
+		'''
+		if item in self.items:
+			self.remove(item)
+
+		r = self._cellRange(bounds)
+		if (r[2] - r[0] + 1) * (r[3] - r[1] + 1) > self.maxCells:
+			self.large.add(item)
+			self.items[item] = (bounds, None)
+			return
+
+		for i in xrange(r[0], r[2] + 1):
+			for j in xrange(r[1], r[3] + 1):
+				cell = self.cells.get((i, j))
+				if cell is None:
+					cell = self.cells[(i, j)] = set()
+				cell.add(item)
+		self.items[item] = (bounds, r)
+
+
+	def remove(self, item):
+		'''
+		Remove an item (if it is in the grid)
+		'''
+		entry = self.items.pop(item, None)
+		if entry is None:
+			return
+
+		r = entry[1]
+		if r is None:
+			self.large.discard(item)
+			return
+
+		for i in xrange(r[0], r[2] + 1):
+			for j in xrange(r[1], r[3] + 1):
+				cell = self.cells[(i, j)]
+				cell.discard(item)
+				if not cell:
+					del self.cells[(i, j)]
+
+
+	def update(self, item, bounds):
+		'''
+		Change the bounds of an item, only touching the cells if it
+		moved into different ones
+		'''
+		entry = self.items.get(item)
+		if entry is not None and entry[1] is not None and entry[1] == self._cellRange(bounds):
+			self.items[item] = (bounds, entry[1])
+		else:
+			self.insert(item, bounds)
+
+
+	def clear(self):
+		'''
+		Remove all items
+		'''
+		self.cells = {}
+		self.large = set()
+		self.items = {}
+
+
+	def query(self, bounds):
+		'''
+		Returns the set of items whose bounds overlap the given bounds
+		'''
+		r = self._cellRange(bounds)
+		candidates = set(self.large)
+
+		if (r[2] - r[0] + 1) * (r[3] - r[1] + 1) > len(self.cells):
+			# Cheaper to look at the occupied cells than the covered ones
+			for (i, j), cell in self.cells.iteritems():
+				if r[0] <= i <= r[2] and r[1] <= j <= r[3]:
+					candidates.update(cell)
+		else:
+			for i in xrange(r[0], r[2] + 1):
+				for j in xrange(r[1], r[3] + 1):
+					cell = self.cells.get((i, j))
+					if cell is not None:
+						candidates.update(cell)
+
+		items = self.items
+		return set(item for item in candidates if intersectsBounds(items[item][0], bounds))
+
+
+	def queryPoint(self, x, y):
+		'''
+		Returns the set of items whose bounds contain the point x, y
+		'''
+		return self.query((x, y, x, y))
+
@@ -1,16 +1,75 @@
-from py2dgui.shaders import shaderlist 
-from py2dgui.base import MatrixStack
+from py2dgui.shaders import getShaderClass, FrameUniforms, renderState, sumCounters
+from py2dgui.batch import PrimitiveBatch
+from py2dgui.spatial import SpatialGrid
+from py2dgui.picking import PickBuffer
+from py2dgui.stats import FrameStats
+from py2dgui.trace import tracer
+from py2dgui.base import intersectsBounds, unionBounds, projectionMatrix
 
 from OpenGL.GL import	GL_BLEND,               \
+						GL_SCISSOR_TEST,        \
+						GL_COLOR_BUFFER_BIT,    \
+						GL_FRAMEBUFFER,         \
+						GL_READ_FRAMEBUFFER,    \
+						GL_DRAW_FRAMEBUFFER,    \
+						GL_FRAMEBUFFER_BINDING, \
+						GL_FRAMEBUFFER_COMPLETE,\
+						GL_RENDERBUFFER,        \
+						GL_COLOR_ATTACHMENT0,   \
+						GL_DEPTH_ATTACHMENT,    \
+						GL_RGBA8,               \
+						GL_DEPTH_COMPONENT24,   \
+						GL_NEAREST,             \
 						GL_SRC_ALPHA,           \
 						GL_ONE_MINUS_SRC_ALPHA, \
+						GL_DEPTH_TEST,          \
+						GL_DEPTH_BUFFER_BIT,    \
+						GL_LEQUAL,              \
+						GL_TRUE,                \
+						GL_FALSE,               \
 						glEnable,               \
+						glDisable,              \
+						glClear,                \
+						glDepthFunc,            \
+						glDepthMask,            \
+						glScissor,              \
+						glGetIntegerv,          \
+						glGenFramebuffers,      \
+						glBindFramebuffer,      \
+						glDeleteFramebuffers,   \
+						glFramebufferRenderbuffer, \
+						glCheckFramebufferStatus,  \
+						glGenRenderbuffers,     \
+						glBindRenderbuffer,     \
+						glDeleteRenderbuffers,  \
+						glRenderbufferStorage,  \
+						glBlitFramebuffer,      \
 						glBlendFunc
 						
 from time import time
+from math import floor, ceil
+from threading import Condition
 
-from numpy import array
 
+def _countStateChanges(keys):
+	'''
+	Returns the number of shader, texture and buffer changes
+	needed to draw a list of state keys in order
+	'''
+	changes = 0
+	for a, b in zip(keys, keys[1:]):
+		changes += (a[0] != b[0]) + (a[1] != b[1]) + (a[2] != b[2])
+	return changes
+	
+	
+def _boundsInside(inner, outer):
+	'''
+	Returns True if the bounding box inner is entirely inside outer
+	'''
+	return inner[0] >= outer[0] and inner[1] >= outer[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+	
+	
+	
 class Stage(object):
 	'''
 	Main object from which all other py2dgui objects are rendered
@@ -25,15 +84,108 @@ class Stage(object):
 		
 		self.shaders = {}
 		
-		# Store current matrixes
+		# Skip actors whose bounds are entirely off screen
+		self.culling = True
+		
+		# Camera space bounds of every actor on the stage, kept up to
+		# date from the actors that moved since the last query
+		self.index = SpatialGrid()
+		self._movedActors = set()
+		
+		# Draw order of every actor on the stage (rebuilt when actors
+		# are added or removed)
+		self._order = {}
+		self._orderDirty = False
+		
+		# Groups cached as textures (in draw order), and the actors that
+		# are drawn by a cached or frozen group rather than by the stage
+		self._cachedGroups = []
+		self._groupDrawn = set()
+		
+		# Actors found on screen by the last render, and all the
+		# actors with something to draw (when not culling)
+		self._visible = None
+		self._drawable = None
+		
+		# Reorder the draw list to group actors drawn with the same
+		# shader, texture and buffer (only where they don't overlap)
+		self.sorting = False
+		
+		# How many earlier runs of actors the sort looks back through
+		self.sortWindow = 32
+		
+		# Draw list, and the (actors, batching, sorting) it was built from
+		self._drawList = None
+		self._drawListSource = None
+		
+		# Binds made in the last frame, and how many the sort saved
+		self.stateChanges = 0
+		self.stateChangesSaved = 0
+		
+		# Draw opaque actors front to back with the depth buffer, then
+		# blend the translucent ones back to front. Only turn this on when
+		# the framebuffer being drawn to has a depth buffer, without one
+		# the opaque actors come out in reverse order
+		self.depthTesting = False
+		
+		# Only redraw the parts of the stage that changed. The stage is drawn
+		# into its own framebuffer, which keeps the rest, and copied to the
+		# bound framebuffer every frame (cleared with the current clear color)
+		self.partialRedraw = False
+		
+		# Redraw everything if more than this fraction of the stage changed
+		self.damageThreshold = 0.5
+		
+		# Most areas to redraw separately, more are merged into one
+		self.maxDamageRects = 16
+		
+		# Areas that changed since the last frame (camera space bounds),
+		# or everything
+		self._damage = []
+		self._fullDamage = True
+		
+		# Framebuffer and renderbuffers for the partial redraw
+		self._redrawBuffer = None
+		self._redrawSize = (0, 0)
+		
+		# Incremented whenever an actor is added, removed or moved
+		self.revision = 0
+		
+		# Offscreen buffer for GPU picking (created on first use)
+		self.pickBuffer = None
+		
+		# Set when something changed since the last render, so host loops
+		# only need to render when there is something new to show
+		self._changed = True
+		self._changeCondition = Condition()
+		
+		# Most frames per second to render while things are changing
+		# (None for no limit)
+		self.targetFps = 60
+		
+		# When the last render started
+		self.lastRender = 0
+		
+		# Draw PrimitiveActors through a shared batch
+		self.batching = True
+		self.batch = PrimitiveBatch()
+		
+		# Store current projection matrix
 		self.projection_matrix = None
-		self.modelCamera_matrix = MatrixStack()
 		
 		# Time the stage was constructed
 		self.startTime = time()
 		
 		self.fps = 0
 		
+		# Percentiles of the CPU, GPU and frame to frame times
+		# (frame to frame times include any time spent idle)
+		self.frameStats = FrameStats()
+		
+		# GL work done in the last frame, by actortype
+		# (see shaders.counterNames for the counters)
+		self.renderCounters = {}
+		
 		self.setup()
 		self.resize(width, height)
 		
@@ -46,6 +198,9 @@ class Stage(object):
 		glEnable(GL_BLEND)
 		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 		
+		# Uniforms shared by all the shaders
+		self.frameUniforms = FrameUniforms()
+		
 		
 	def getShader(self, shadername):
 		'''
@@ -57,18 +212,339 @@ class Stage(object):
 		
 		
 		# Otherwise create a new instance of the shader
-		for shader in shaderlist:
-			if shader.name == shadername:
-				s = shader()
-				self.shaders[shadername] = s
-				return self.shaders[shadername]
+		self.shaders[shadername] = getShaderClass(shadername)()
+		return self.shaders[shadername]
+		
+		
+	def flushBatch(self):
+		'''
+		Draw any PrimitiveActors waiting in the batch
+		'''
+		if self.batching:
+			self.batch.flush(self)
+		
+		
+	def _attachActor(self, actor):
+		'''
+		Called when an actor is added to the stage (or to an actor on it)
+		'''
+		self._movedActors.add(actor)
+		self._orderDirty = True
+		self.revision += 1
+		self._markDirty()
+		
+	def _detachActor(self, actor):
+		'''
+		Called when an actor is removed from the stage
+		'''
+		self.addDamage(self.index.getBounds(actor))
+		self._movedActors.discard(actor)
+		self.index.remove(actor)
+		self._orderDirty = True
+		self.revision += 1
+		self._markDirty()
+		
+	def _actorMoved(self, actor):
+		'''
+		Called when the bounds of an actor on the stage change
+		'''
+		# Where it was needs redrawing now, where it is when it's found
+		self.addDamage(self.index.getBounds(actor))
+		self._movedActors.add(actor)
+		self.revision += 1
+		self._markDirty()
+		
+	def _actorChanged(self, actor):
+		'''
+		Called when how an actor on the stage looks changes
+		'''
+		self.addDamage(self.index.getBounds(actor))
+		self._markDirty()
+		
+	def _orderChanged(self):
+		'''
+		Called when the draw order of the actors may have changed
+		'''
+		self._orderDirty = True
+		self.revision += 1
+		self.damageAll()
+		self._markDirty()
+		
+		
+	def _markDirty(self):
+		'''
+		Note that the stage needs rendering again, and wake anything
+		waiting for a change
+		'''
+		if self._changed:
+			return
+		with self._changeCondition:
+			self._changed = True
+			self._changeCondition.notifyAll()
+			
+	def needsRedraw(self):
+		'''
+		Returns True if rendering now would draw something different
+		to the last render
+		'''
+		return self._changed or len(self.animations) > 0
+		
+	def waitForChange(self, timeout=None):
+		'''
+		Block until the stage needs rendering, or until timeout seconds
+		have passed. While things are changing, waits until the next frame
+		is due at targetFps. Returns True if the stage should be rendered
+		'''
+		deadline = None if timeout is None else time() + timeout
+		with self._changeCondition:
+			while True:
+				now = time()
+				if self.needsRedraw():
+					if not self.targetFps:
+						return True
+					due = self.lastRender + 1.0 / self.targetFps
+					if now >= due:
+						return True
+					wait = due - now
+				else:
+					wait = None
+					
+				if deadline is not None:
+					if now >= deadline:
+						return False
+					wait = deadline - now if wait is None else min(wait, deadline - now)
+				self._changeCondition.wait(wait)
+		
+		
+	def addDamage(self, bounds):
+		'''
+		Mark an area of the stage (xmin, ymin, xmax, ymax) as needing
+		to be redrawn
+		'''
+		if bounds is None or self._fullDamage:
+			return
+		self._damage.append(bounds)
+		
+		# Too many areas to redraw separately
+		if len(self._damage) > self.maxDamageRects:
+			union = None
+			for bounds in self._damage:
+				union = unionBounds(union, bounds)
+			self._damage = [union]
+			
+	def damageAll(self):
+		'''
+		Mark the whole stage as needing to be redrawn
+		'''
+		self._fullDamage = True
+		self._damage = []
+		
+		
+	def _updateIndex(self):
+		'''
+		Bring the spatial index and the draw order up to date
+		'''
+		if self._movedActors:
+			for actor in self._movedActors:
+				bounds = actor.getWorldBounds()
+				if bounds is None:
+					self.index.remove(actor)
+				else:
+					self.index.update(actor, bounds)
+					self.addDamage(bounds)
+			self._movedActors = set()
+			self._visible = None
+			self._drawable = None
+			
+		if self._orderDirty:
+			# Actors are drawn by layer, then parents first in the
+			# order they were added
+			order = {}
+			cachedGroups = []
+			groupDrawn = set()
+			stack = [(actor, 0, False, False) for actor in reversed(self.actors)]
+			while stack:
+				actor, layer, cached, frozen = stack.pop()
+				if actor._layer is not None:
+					layer = actor._layer
+				order[actor] = (layer, len(order))
+				
+				# Everything in a cached group is in its texture, and
+				# primitives in a frozen group are in its buffer
+				if cached or (frozen and actor.actortype == 'primitive'):
+					groupDrawn.add(actor)
+				if actor._cacheAsTexture:
+					cachedGroups.append(actor)
+					
+				cached = cached or actor._cacheAsTexture
+				frozen = frozen or actor._frozen
+				stack.extend((child, layer, cached, frozen) for child in reversed(actor.children))
+			self._order = order
+			self._cachedGroups = cachedGroups
+			self._groupDrawn = groupDrawn
+			self._orderDirty = False
+			self._visible = None
+			self._drawable = None
+			
+			
+	def getActorsInBounds(self, bounds):
+		'''
+		Returns the actors whose own bounds (not including their children)
+		overlap bounds (xmin, ymin, xmax, ymax), in the order they are drawn
+		'''
+		self._updateIndex()
+		return sorted(self.index.query(bounds), key=self._order.__getitem__)
+		
+	def getActorsAt(self, x, y):
+		'''
+		Returns the actors whose own bounds contain the point x, y,
+		in the order they are drawn
+		'''
+		return self.getActorsInBounds((x, y, x, y))
+		
+	def getVisibleActors(self):
+		'''
+		Returns the actors with something to draw on screen,
+		in the order they are drawn
+		'''
+		self._updateIndex()
+		if self._visible is None:
+			self._visible = self.getActorsInBounds((0, 0, self.width, self.height))
+		return self._visible
+		
+	def getDrawableActors(self):
+		'''
+		Returns all the actors with something to draw,
+		in the order they are drawn
+		'''
+		self._updateIndex()
+		if self._drawable is None:
+			self._drawable = sorted(self.index.items, key=self._order.__getitem__)
+		return self._drawable
+		
+		
+	def getDrawList(self):
+		'''
+		Returns the actors to draw this frame, in the order to draw them
+		'''
+		if self.culling:
+			actors = self.getVisibleActors()
+		else:
+			actors = self.getDrawableActors()
+			
+		# Only build the list again if the actors (or how they are drawn) changed
+		source = self._drawListSource
+		if source is None or source[0] is not actors or source[1:] != (self.batching, self.sorting):
+			self._drawListSource = (actors, self.batching, self.sorting)
+			
+			# Leave out the actors drawn by their groups
+			if self._groupDrawn:
+				actors = [actor for actor in actors if actor not in self._groupDrawn]
+				
+			if self.sorting:
+				self._drawList = self._sortDrawList(actors)
+			else:
+				self._drawList = actors
+				self.stateChangesSaved = 0
+		return self._drawList
+		
+	def _sortDrawList(self, actors):
+		'''
+		Returns actors reordered so that those drawn with the same state
+		are next to each other. An actor is only moved in front of actors
+		in its layer that it doesn't overlap, so the result looks the same
+		'''
+		# Runs of actors with the same state, [key, layer, bounds, actors]
+		runs = []
+		keys = []
+		for actor in actors:
+			key = actor._getStateKey(self)
+			layer = self._order[actor][0]
+			bounds = actor.getWorldBounds()
+			keys.append(key)
+			
+			# Look back for a run with the same state that nothing in between overlaps
+			target = None
+			for run in reversed(runs[-self.sortWindow:]):
+				if run[1] != layer:
+					break
+				if run[0] == key:
+					target = run
+					break
+				if intersectsBounds(run[2], bounds):
+					break
+					
+			if target is None:
+				runs.append([key, layer, bounds, [actor]])
+			else:
+				target[2] = unionBounds(target[2], bounds)
+				target[3].append(actor)
+				
+		self.stateChangesSaved = _countStateChanges(keys) - _countStateChanges([run[0] for run in runs])
+		return [actor for run in runs for actor in run[3]]
+		
+		
+	def pick(self, x, y):
+		'''
+		Returns the topmost actor drawn over the point x, y
+		(in stage coordinates, with the origin at the bottom left)
+		or None if there isn't one
+		'''
+		for actor in reversed(self.getActorsAt(x, y)):
+			if actor.containsPoint(x, y):
+				return actor
+		return None
+		
+	def queryRect(self, x0, y0, x1, y1, contained=False):
+		'''
+		Returns the actors drawn inside the rectangle from x0, y0 to x1, y1,
+		in the order they are drawn. If contained is True, only actors
+		entirely inside the rectangle are returned
+		'''
+		bounds = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+		actors = self.getActorsInBounds(bounds)
+		if contained:
+			return [actor for actor in actors if _boundsInside(actor.getWorldBounds(), bounds)]
+		return [actor for actor in actors if _boundsInside(actor.getWorldBounds(), bounds) or actor.intersectsBounds(bounds)]
+		
+		
+	def pickPixel(self, x, y, wait=False):
+		'''
+		Returns the topmost actor drawn at the pixel x, y using the GPU
+		picking pass (exact for any overlap or rotation, at pixel precision).
+		The read back is asynchronous, so unless wait is True the result
+		is for the pixel asked for on an earlier call (None until one
+		is ready)
+		'''
+		if self.pickBuffer is None:
+			self.pickBuffer = PickBuffer(self)
+		return self.pickBuffer.pick(x, y, wait)
 		
-		# Shader could not be found, raise exception	
-		raise Exception("Could not find shader that matched '%s'" % shadername)
+		
+	def isCulled(self, actor):
+		'''
+		Returns True if an actor and all of its descendants are off screen
+		(or have nothing to draw)
+		'''
+		if not self.culling:
+			return False
+		bounds = actor.getBounds()
+		if bounds is None:
+			return True
+		return bounds[2] < 0 or bounds[0] > self.width or bounds[3] < 0 or bounds[1] > self.height
+		
+		
+	def getRenderTotals(self):
+		'''
+		Returns the render counters of this stage's last frame summed
+		over every actortype
+		'''
+		return sumCounters(self.renderCounters)
 		
 		
 	def addAnimation(self, animation):
 		self.animations.append(animation)
+		self._markDirty()
 		
 				
 	def resize(self, w, h):
@@ -78,17 +554,13 @@ class Stage(object):
 		
 		self.width = w
 		self.height = h
+		self._visible = None
+		self.revision += 1
+		self.damageAll()
+		self._markDirty()
 		
-		n = 0.5 # zNear
-		f  = 3.0 # zFar
-		
-		self.projection_matrix = array([
-									
-				[ 2/float(w),     0,           0,            -1        ],
-				[     0,      2/float(h),      0,            -1        ],
-				[     0,          0,      -2/(f-n),          -1        ],
-				[     0,          0,           0,             1        ]
-										],'f')
+		self.projection_matrix = projectionMatrix(w, h)
+		self.frameUniforms.setProjection(self.projection_matrix)
 		
 		
 	def addActor(self, actor):
@@ -97,6 +569,7 @@ class Stage(object):
 		'''
 		if actor not in self.actors:
 			self.actors.append(actor)
+			actor._setStage(self)
 			
 	def removeActor(self, actor):
 		'''
@@ -104,38 +577,227 @@ class Stage(object):
 		'''
 		if actor in self.actors:
 			self.actors.remove(actor)
+			actor._setStage(None)
 			
 	def clearStage(self):
 		'''
 		Remove all actors from the stage
 		'''
+		for actor in self.actors:
+			actor._setStage(None)
 		self.actors = []
 		
 
+	def _renderActors(self, actors):
+		'''
+		Draw a list of actors in order
+		'''
+		if self.depthTesting:
+			self._renderDepthPasses(actors)
+		else:
+			for actor in actors:
+				actor._draw(self)
+			self.flushBatch()
+			
+			
+	def _getDamageRegions(self):
+		'''
+		Returns the pixel rectangles (x, y, w, h) that need redrawing,
+		or None to redraw everything
+		'''
+		if self._fullDamage:
+			return None
+		
+		regions = []
+		area = 0
+		for bounds in self._damage:
+			# Round outwards, with a pixel extra for antialiasing
+			x0 = max(int(floor(bounds[0])) - 1, 0)
+			y0 = max(int(floor(bounds[1])) - 1, 0)
+			x1 = min(int(ceil(bounds[2])) + 1, self.width)
+			y1 = min(int(ceil(bounds[3])) + 1, self.height)
+			if x1 > x0 and y1 > y0:
+				regions.append((x0, y0, x1 - x0, y1 - y0))
+				area += (x1 - x0) * (y1 - y0)
+				
+		if area > self.damageThreshold * self.width * self.height:
+			return None
+		return regions
+		
+		
+	def _bindRedrawBuffer(self):
+		'''
+		Bind the framebuffer the stage is drawn into for partial redraws
+		(creating it if needed)
+		'''
+		size = (self.width, self.height)
+		if self._redrawBuffer is not None and self._redrawSize != size:
+			self._deleteRedrawBuffer()
+			
+		if self._redrawBuffer is None:
+			fbo = glGenFramebuffers(1)
+			color, depth = glGenRenderbuffers(2)
+			glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+			
+			glBindRenderbuffer(GL_RENDERBUFFER, color)
+			glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, self.width, self.height)
+			glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, color)
+			
+			glBindRenderbuffer(GL_RENDERBUFFER, depth)
+			glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, self.width, self.height)
+			glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth)
+			glBindRenderbuffer(GL_RENDERBUFFER, 0)
+			
+			if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+				raise Exception("Could not create the framebuffer for partial redraws")
+				
+			self._redrawBuffer = (fbo, color, depth)
+			self._redrawSize = size
+			self.damageAll()
+		else:
+			glBindFramebuffer(GL_FRAMEBUFFER, self._redrawBuffer[0])
+			
+	def _deleteRedrawBuffer(self):
+		fbo, color, depth = self._redrawBuffer
+		glDeleteFramebuffers(1, [fbo])
+		glDeleteRenderbuffers(2, [color, depth])
+		self._redrawBuffer = None
+		
+		
+	def _renderPartial(self, actors):
+		'''
+		Redraw the parts of the stage that changed into the redraw
+		buffer, then copy all of it to the bound framebuffer
+		'''
+		previous = glGetIntegerv(GL_FRAMEBUFFER_BINDING)
+		self._bindRedrawBuffer()
+		
+		regions = self._getDamageRegions()
+		if regions is None:
+			glClear(GL_COLOR_BUFFER_BIT)
+			self._renderActors(actors)
+		elif regions:
+			glEnable(GL_SCISSOR_TEST)
+			for x, y, w, h in regions:
+				glScissor(x, y, w, h)
+				glClear(GL_COLOR_BUFFER_BIT)
+				
+				# Only the actors over the region need drawing
+				bounds = (x, y, x + w, y + h)
+				self._renderActors([actor for actor in self.getActorsInBounds(bounds) if actor not in self._groupDrawn])
+			glDisable(GL_SCISSOR_TEST)
+			
+		glBindFramebuffer(GL_READ_FRAMEBUFFER, self._redrawBuffer[0])
+		glBindFramebuffer(GL_DRAW_FRAMEBUFFER, previous)
+		glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, self.width, self.height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+		glBindFramebuffer(GL_FRAMEBUFFER, previous)
+		
+		
+	def _renderDepthPasses(self, actors):
+		'''
+		Draw the opaque actors front to back without blending, so the depth
+		test rejects the pixels that are covered, then draw the translucent
+		actors back to front over them
+		'''
+		# Later actors are drawn nearer (depth -1 is nearest)
+		step = 2.0 / (len(actors) + 1)
+		opaque = []
+		translucent = []
+		for i, actor in enumerate(actors):
+			actor.depth = 1.0 - step * (i + 1)
+			if actor.isOpaque():
+				opaque.append(actor)
+			else:
+				translucent.append(actor)
+				
+		glClear(GL_DEPTH_BUFFER_BIT)
+		glEnable(GL_DEPTH_TEST)
+		
+		# Equal depths come from the same actor, which draws in order
+		glDepthFunc(GL_LEQUAL)
+		
+		glDisable(GL_BLEND)
+		for actor in reversed(opaque):
+			actor._draw(self)
+		self.flushBatch()
+		
+		glEnable(GL_BLEND)
+		glDepthMask(GL_FALSE)
+		for actor in translucent:
+			actor._draw(self)
+		self.flushBatch()
+		
+		glDepthMask(GL_TRUE)
+		glDisable(GL_DEPTH_TEST)
+		
+		
 	def render(self):
 		'''
 		Render all actors on the stage
 		'''
 		
 		before = time()
+		self.lastRender = before
+		self.frameStats.beginFrame()
+		tracer.beginFrame()
+		renderState.setActorType('stage')
 		
 		# Do our animations
-		remove = []
-		for animation in self.animations:
-			if animation.complete == True:
-				remove.append(animation)
-				continue
-			animation.update(time())
-			
-		# Remove any finished animations
-		for i in remove:
-			self.animations.remove(i)
+		with tracer.span('animations', 'stage'):
+			remove = []
+			for animation in self.animations:
+				if animation.complete == True:
+					remove.append(animation)
+					continue
+				animation.update(time())
+				
+			# Remove any finished animations
+			for i in remove:
+				self.animations.remove(i)
+			
+		# Anything changed from here on needs another render
+		with self._changeCondition:
+			self._changed = False
+			
+		# Upload the shared uniforms if they changed
+		self.frameUniforms.upload()
 							
 		# Render our actors
-		for actor in self.actors:
-			actor._render(self, self.projection_matrix, self.modelCamera_matrix)
+		changes = renderState.changes
+		with tracer.span('traversal', 'stage'):
+			actors = self.getDrawList()
+		
+		# Redraw the textures of cached groups that changed, innermost
+		# first as they are drawn into the outer ones
+		with tracer.span('group caches', 'stage'):
+			for group in reversed(self._cachedGroups):
+				if group._cacheDirty and not self.isCulled(group):
+					group._renderCache(self)
+					
+		with tracer.span('draw', 'stage'):
+			if self.partialRedraw:
+				self._renderPartial(actors)
+			else:
+				self._renderActors(actors)
+				
+				# The redraw buffer (if there is one) is now out of date
+				self.damageAll()
+		self.stateChanges = renderState.changes - changes
+		
+		# Start collecting the damage for the next frame
+		if self.partialRedraw:
+			self._damage = []
+			self._fullDamage = False
+		
+		# Leave nothing bound for other code
+		renderState.setActorType('stage')
+		renderState.reset()
+		self.renderCounters = renderState.endFrame()
 		after = time()
 		
+		self.frameStats.endFrame()
+		tracer.endFrame()
+		
 		# record the framerate
 		framerate = after - before
 		if framerate > 0:
@@ -0,0 +1,148 @@
+from OpenGL.GL import   glGenQueries,                 \
+						glDeleteQueries,              \
+						glBeginQuery,                 \
+						glEndQuery,                   \
+						glGetQueryObjectuiv,          \
+						GL_TIME_ELAPSED,              \
+						GL_QUERY_RESULT,              \
+						GL_QUERY_RESULT_AVAILABLE
+
+from numpy import array, zeros, percentile, uint32
+
+from collections import deque
+from time import time
+
+
+
+class FrameStats(object):
+	'''
+	Rolling record of how long the last frames took: the CPU time spent
+	submitting each frame, the GPU time spent drawing it (read from timer
+	queries a few frames later, so reading never waits for the GPU) and
+	the time between the starts of consecutive frames.
+	All times are in seconds
+	'''
+	def __init__(self, window=300):
+		# Frames the statistics are taken over
+		self.window = window
+		self.cpuTimes = deque(maxlen=window)
+		self.gpuTimes = deque(maxlen=window)
+		self.intervals = deque(maxlen=window)
+
+		# Time GPU work with timer queries
+		self.gpuTiming = True
+
+		# Queries waiting for their results (oldest first), and the
+		# query of the frame in progress
+		self.pending = deque()
+		self.free = []
+		self.query = None
+
+		# When the frame in progress and the one before it started
+		self.frameStart = None
+		self.lastStart = None
+
+
+	def setWindow(self, window):
+		'''
+		Change how many frames the statistics are taken over
+		'''
+		self.window = window
+		self.cpuTimes = deque(self.cpuTimes, maxlen=window)
+		self.gpuTimes = deque(self.gpuTimes, maxlen=window)
+		self.intervals = deque(self.intervals, maxlen=window)
+
+
+	def beginFrame(self):
+		'''
+		Called as a frame starts
+		'''
+		self.frameStart = time()
+		if self.lastStart is not None:
+			self.intervals.append(self.frameStart - self.lastStart)
+		self.lastStart = self.frameStart
+
+		if self.gpuTiming:
+			if self.free:
+				self.query = self.free.pop()
+			else:
+				self.query = glGenQueries(1)[0]
+			glBeginQuery(GL_TIME_ELAPSED, self.query)
+
+
+	def endFrame(self):
+		'''
+		Called once all of a frame has been submitted
+		'''
+		self.cpuTimes.append(time() - self.frameStart)
+
+		if self.query is not None:
+			glEndQuery(GL_TIME_ELAPSED)
+			self.pending.append(self.query)
+			self.query = None
+		self._collect()
+
+
+	def _collect(self):
+		'''
+		Read the results of the queries that have finished
+		'''
+		# PyOpenGL can't read into 64 bit arrays, 32 bits of nanoseconds
+		# is over 4 seconds which is plenty for a frame
+		available = zeros(1, uint32)
+		result = zeros(1, uint32)
+		while self.pending:
+			query = self.pending[0]
+			glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE, available)
+
+			# Queries finish in order, so the rest aren't ready either
+			if not available[0]:
+				break
+
+			glGetQueryObjectuiv(query, GL_QUERY_RESULT, result)
+			self.gpuTimes.append(result[0] / 1e9)
+			self.free.append(self.pending.popleft())
+
+
+	def reset(self):
+		'''
+		Forget the frames recorded so far
+		'''
+		self.cpuTimes.clear()
+		self.gpuTimes.clear()
+		self.intervals.clear()
+		self.lastStart = None
+
+
+	def _summarize(self, samples):
+		if not samples:
+			return None
+		a = array(samples)
+		p50, p95, p99 = percentile(a, [50, 95, 99])
+		return {'p50' : p50, 'p95' : p95, 'p99' : p99, 'worst' : a.max(), 'frames' : len(a)}
+
+	def getSummary(self):
+		'''
+		Returns the 50th, 95th and 99th percentile and the worst time
+		over the window, for the CPU time, GPU time and interval between
+		frames (None for any that have no frames yet)
+		'''
+		return {
+			'cpu'      : self._summarize(self.cpuTimes),
+			'gpu'      : self._summarize(self.gpuTimes),
+			'interval' : self._summarize(self.intervals),
+		}
+
+
+	def delete(self):
+		'''
+		Delete the OpenGL objects
+		'''
+		queries = list(self.pending) + self.free
+		if self.query is not None:
+			queries.append(self.query)
+		if queries:
+			glDeleteQueries(len(queries), queries)
+		self.pending.clear()
+		self.free = []
+		self.query = None
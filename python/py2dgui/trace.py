@@ -0,0 +1,183 @@
+import os
+import json
+import ctypes
+import ctypes.util
+
+from collections import deque
+
+try:
+	from thread import get_ident
+except ImportError:
+	from threading import get_ident
+
+try:
+	from time import monotonic
+except ImportError:
+	# Python 2 has no monotonic clock, read CLOCK_MONOTONIC directly
+	class _timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	_CLOCK_MONOTONIC = 1
+	_librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+	_clock_gettime = _librt.clock_gettime
+	_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+	def monotonic():
+		'''
+		Seconds from an arbitrary point, never goes backwards
+		'''
+		t = _timespec()
+		if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+		return t.tv_sec + t.tv_nsec * 1e-9
+
+
+
+class _Span(object):
+	'''
+	Records the time spent inside a with block
+	'''
+	__slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+	def __init__(self, tracer, name, category, args):
+		self.tracer = tracer
+		self.name = name
+		self.category = category
+		self.args = args
+
+	def __enter__(self):
+		self.start = monotonic()
+		return self
+
+	def __exit__(self, *exc):
+		self.tracer.record(self.name, self.category, self.start, monotonic(), self.args)
+		return False
+
+
+class _NullSpan(object):
+	'''
+	Span used while the tracer is disabled
+	'''
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+_nullSpan = _NullSpan()
+
+
+
+class Tracer(object):
+	'''
+	Records how long the phases of each frame take, and writes them as
+	Chrome trace events (viewable in chrome://tracing or Perfetto).
+	Events go into a bounded buffer, so tracing can run all the time
+	and the last few seconds can be dumped when a frame is slow
+	'''
+	def __init__(self, maxEvents=100000):
+		# Tracing is off until enabled
+		self.enabled = False
+
+		# (name, category, start, duration, thread, args), oldest first
+		self.events = deque(maxlen=maxEvents)
+
+		# Frames taking longer than this many seconds (None to never dump)
+		# dump the last dumpSeconds of events to dumpPath (formatted
+		# with the time of the dump in milliseconds)
+		self.slowFrame = None
+		self.dumpSeconds = 5.0
+		self.dumpPath = 'py2dgui-trace-%d.json'
+
+		# When the last dump was made, a slow frame doesn't dump
+		# events that were already dumped
+		self.lastDump = None
+
+		# Start of the frame in progress
+		self.frameStart = None
+
+		self.pid = os.getpid()
+
+
+	def span(self, name, category='render', args=None):
+		'''
+		Returns a context manager recording the time spent inside it
+		'''
+		if not self.enabled:
+			return _nullSpan
+		return _Span(self, name, category, args)
+
+	def record(self, name, category, start, end, args=None):
+		'''
+		Record an event that ran from start to end (monotonic seconds)
+		'''
+		self.events.append((name, category, start, end - start, get_ident(), args))
+
+
+	def beginFrame(self):
+		if self.enabled:
+			self.frameStart = monotonic()
+
+	def endFrame(self):
+		'''
+		Record the frame, and dump the recent events if it was slow
+		'''
+		if not self.enabled or self.frameStart is None:
+			return
+		start = self.frameStart
+		end = monotonic()
+		self.record('frame', 'frame', start, end)
+		self.frameStart = None
+
+		if self.slowFrame is not None and end - start > self.slowFrame:
+			# Don't dump again until the events have been replaced
+			if self.lastDump is None or end - self.lastDump >= self.dumpSeconds:
+				self.lastDump = end
+				self.dump(self.dumpPath % int(end * 1000), self.dumpSeconds)
+
+
+	def getEvents(self, seconds=None):
+		'''
+		Returns the recorded events as Chrome trace events, only those
+		that ended in the last seconds if it is given
+		'''
+		events = self.events
+		if seconds is not None:
+			since = monotonic() - seconds
+			events = [e for e in events if e[2] + e[3] >= since]
+
+		result = []
+		for name, category, start, duration, thread, args in events:
+			event = {
+				'name' : name,
+				'cat'  : category,
+				'ph'   : 'X',
+				'ts'   : start * 1e6,
+				'dur'  : duration * 1e6,
+				'pid'  : self.pid,
+				'tid'  : thread,
+			}
+			if args:
+				event['args'] = args
+			result.append(event)
+		return result
+
+	def dump(self, path, seconds=None):
+		'''
+		Write the recorded events to a Chrome trace JSON file
+		'''
+		with open(path, 'w') as f:
+			json.dump({'traceEvents' : self.getEvents(seconds), 'displayTimeUnit' : 'ms'}, f)
+
+
+	def clear(self):
+		'''
+		Forget the recorded events
+		'''
+		self.events.clear()
+		self.lastDump = None
+
+
+# Tracer used by the stage, actors and atlases
+tracer = Tracer()
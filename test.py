@@ -44,6 +44,14 @@ class MyStage(Stage):
 	def resize(self, w, h):
 		glViewport(0,0,w,h)
 		super(MyStage, self).resize(w,h)
+		
+	def idle(self):
+		'''
+		Only ask GLUT to redraw when the stage changed. The short timeout
+		gives GLUT a chance to handle its events
+		'''
+		if self.waitForChange(0.05):
+			GLUT.glutPostRedisplay()
 	  
 	  
 if __name__ == "__main__":
@@ -59,7 +67,7 @@ if __name__ == "__main__":
 	stage = MyStage(width, height)
 	
 	GLUT.glutDisplayFunc(stage.render)
-	GLUT.glutIdleFunc(stage.render)
+	GLUT.glutIdleFunc(stage.idle)
 	GLUT.glutReshapeFunc(stage.resize)
 	
 	
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Headless smoke test: renders text and shapes into an OffscreenStage
+with the default settings. Run with PYOPENGL_PLATFORM=egl or osmesa
+(defaults to egl)
+'''
+import os
+import sys
+
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
+root = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(root, 'python'))
+
+from py2dgui import *
+from py2dgui.offscreen import OffscreenStage, OffscreenContext
+
+font = os.path.join(root, 'fonts', 'LiberationSerif-Regular.ttf')
+
+
+
+def test_offscreen():
+	stage = OffscreenStage(320, 240)
+	try:
+		# A red square behind white text
+		square = Square(color=Color(1.0))
+		square.scale(Point(.2, .2, 1))
+		square.translate(Point(40, 200))
+		stage.addActor(square)
+
+		text = TextActor(font, 48, text="Hello World!", color=Color(1, 1, 1))
+		text.translate(Point(10, 100))
+		stage.addActor(text)
+
+		# Enough frames for the GPU timings to be read back
+		stage.renderFrames(10)
+		frame = stage.renderFrame()
+
+		assert frame.shape == (240, 320, 4)
+
+		# Frames are top row first, the square is centered 40 pixels from the top
+		assert tuple(frame[40, 40]) == (255, 0, 0, 255)
+
+		# The text is drawn somewhere in its band
+		band = frame[240 - 150:240 - 80, :, :3]
+		assert (band == 255).all(axis=2).any()
+
+		assert stage.frameStats.getSummary()['cpu']['frames'] == 11
+	finally:
+		stage.delete()
+
+
+
+def _renderTwoStages(contexts):
+	'''
+	Render two stages in turn and check each keeps its own frame
+	'''
+	# Different sizes, so drawing into the other stage's framebuffer shows
+	sizes = [(160, 120), (80, 60)]
+	colors = [Color(1.0), Color(0, 0, 1.0)]
+	pixels = [(255, 0, 0, 255), (0, 0, 255, 255)]
+	
+	stages = []
+	try:
+		for context, (width, height) in zip(contexts, sizes):
+			stages.append(OffscreenStage(width, height, context))
+		
+		# Actors are made in the context of their stage
+		for stage, color in zip(stages, colors):
+			stage.makeCurrent()
+			square = Square(color=color)
+			square.scale(Point(.1, .1, 1))
+			square.translate(Point(stage.width * 3 // 4, stage.height // 2))
+			stage.addActor(square)
+			
+			text = TextActor(font, 24, text="Hi", color=Color(1, 1, 1))
+			text.translate(Point(5, 5))
+			stage.addActor(text)
+			
+		# Twice, so the second round starts from the other stage's binds
+		for i in xrange(2):
+			frames = [stage.renderFrame() for stage in stages]
+			
+		for stage, pixel, frame in zip(stages, pixels, frames):
+			assert frame.shape == (stage.height, stage.width, 4)
+			assert tuple(frame[stage.height // 2, stage.width * 3 // 4]) == pixel
+			assert (frame[:, :, :3] == 255).all(axis=2).any()
+	finally:
+		for stage in stages:
+			stage.delete()
+
+
+def test_sharedContext():
+	_renderTwoStages([None, None])
+
+
+def test_separateContexts():
+	contexts = [OffscreenContext(), OffscreenContext()]
+	try:
+		_renderTwoStages(contexts)
+	finally:
+		for context in contexts:
+			context.delete()
+
+
+
+if __name__ == "__main__":
+	test_offscreen()
+	test_sharedContext()
+	test_separateContexts()
+	print "Offscreen rendering OK"